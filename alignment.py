@@ -0,0 +1,167 @@
+import os
+import hashlib
+import functools
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import cache
+import consts
+import metrics
+
+ALIGNER_SCORES = {
+    'match_score': 2,
+    'mismatch_score': -1,
+    'target_open_gap_score': -1e6,  # Extremely high penalty for opening gaps in the reference
+    'target_extend_gap_score': -1e6,  # Extremely high penalty for extending gaps in the reference
+    'query_open_gap_score': -0.5,
+    'query_extend_gap_score': -0.1,
+}
+# nearly identical sequences are aligned only in the window where they differ, with margins of their common
+# flanks which start at this length and are doubled until the window alignment is the one of the full sequences
+WINDOW_MARGIN = 8
+# cached alignments are keyed by the aligner configuration too, changing it invalidates them
+ALIGNER_KEY = repr((sorted(ALIGNER_SCORES.items()), 'window'))
+# batches with fewer alignments to compute are aligned in the calling process
+MIN_PARALLEL_ALIGNMENTS = 4
+
+# the aligned sequences, in memory in front of a bounded disk cache shared by all the workers
+alignment_cache = cache.TieredCache(consts.ALIGNMENT_CACHE_DIR, consts.ALIGNMENT_CACHE_BYTES,
+                                    consts.ALIGNMENT_CACHE_DISK_BYTES)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def get_aligner():
+    # configured once, and reused by all the alignments of the process. Bio is imported on the first alignment
+    from Bio.Align import PairwiseAligner
+    aligner = PairwiseAligner()
+    for name, value in ALIGNER_SCORES.items():
+        setattr(aligner, name, value)
+    return aligner
+
+
+def format_alignment(alignment):
+    # the rows of the alignment are formatted once, not per character.
+    # in places the ref is -, turn the seq to lowercase
+    ref_row, seq_row = alignment
+    return ''.join([c.lower() if ref_row[i] == '-' else c for i, c in enumerate(seq_row)])
+
+
+@metrics.timed('PairwiseAligner')
+def align_full(ref_seq, seq):
+    return format_alignment(get_aligner().align(ref_seq, seq)[0])
+
+
+def common_prefix_length(a, b):
+    return len(os.path.commonprefix([a, b]))
+
+
+def align_window(ref_window, seq_window, left_margin, right_margin):
+    # the first best alignment of the window, or None if one of the best alignments does not match the first
+    # base of a (non-empty) margin or its last base. otherwise every best alignment of the full sequences
+    # goes through the ends of the window, and the aligner picks the same one of them in both
+    start, end = int(left_margin > 0), int(right_margin > 0)
+    ref_inner, seq_inner = ref_window[start:len(ref_window) - end], seq_window[start:len(seq_window) - end]
+    # the aligner does not align empty sequences
+    if not ref_inner or not seq_inner:
+        return None
+    aligner = get_aligner()
+    alignments = aligner.align(ref_window, seq_window)
+    inner = aligner.align(ref_inner, seq_inner)
+    matched_ends = (start + end) * ALIGNER_SCORES['match_score']
+    try:
+        if abs(alignments.score - inner.score - matched_ends) > 1e-6 or len(alignments) != len(inner):
+            return None
+    except OverflowError:
+        # too many best alignments to count
+        return None
+    return format_alignment(alignments[0])
+
+
+def align(ref_seq, seq):
+    # variants are mostly a few substitutions and small indels away from the reference, only the window
+    # between their common prefix and suffix is aligned. lowercase bases would be taken for insertions
+    if ref_seq.isupper() and seq.isupper():
+        suffix = common_prefix_length(ref_seq[::-1], seq[::-1])
+        prefix = common_prefix_length(ref_seq[:len(ref_seq) - suffix], seq[:len(seq) - suffix])
+        margin = WINDOW_MARGIN
+        while margin < max(prefix, suffix):
+            left, right = min(margin, prefix), min(margin, suffix)
+            # a window of most of the sequences is aligned about as fast as the full sequences
+            if 2 * (len(ref_seq) - prefix - suffix + left + right) > len(ref_seq):
+                break
+            window = align_window(ref_seq[prefix - left:len(ref_seq) - suffix + right],
+                                  seq[prefix - left:len(seq) - suffix + right], left, right)
+            if window is not None:
+                return seq[:prefix - left] + window + seq[len(seq) - suffix + right:]
+            margin *= 2
+    return align_full(ref_seq, seq)
+
+
+def alignment_key(ref_seq, seq):
+    return hashlib.sha256(f'{ALIGNER_KEY}\n{ref_seq}\n{seq}'.encode()).hexdigest()
+
+
+def read_cached(key):
+    aligned_seq = alignment_cache.get(key)
+    return aligned_seq.decode() if aligned_seq is not None else None
+
+
+def write_cached(key, aligned_seq):
+    alignment_cache.put(key, aligned_seq.encode())
+    return aligned_seq
+
+
+def align_sequences(ref_seq, seq):
+    key = alignment_key(ref_seq, seq)
+    aligned_seq = read_cached(key)
+    if aligned_seq is None:
+        aligned_seq = write_cached(key, align(ref_seq, seq))
+    return aligned_seq
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # the workers are not forked from the server, whose other threads may hold locks while it forks
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(max_workers=consts.ALIGNMENT_WORKERS, mp_context=multiprocessing.get_context(method))
+        return _pool
+
+
+def reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+@metrics.timed('align_all')
+def align_all(ref_seq, seqs):
+    # align all the sequences to the reference, the uncached ones in parallel. returns {seq: aligned seq}
+    aligned_seqs, missing = {}, {}
+    for seq in set(seqs):
+        key = alignment_key(ref_seq, seq)
+        aligned_seqs[seq] = read_cached(key)
+        if aligned_seqs[seq] is None:
+            missing[seq] = key
+
+    computed = None
+    if len(missing) >= MIN_PARALLEL_ALIGNMENTS and consts.ALIGNMENT_WORKERS > 1:
+        try:
+            computed = list(get_pool().map(align, [ref_seq] * len(missing), missing))
+        except BrokenProcessPool:
+            # a worker died, the next batch starts a new pool
+            reset_pool()
+    if computed is None:
+        computed = [align(ref_seq, seq) for seq in missing]
+
+    for (seq, key), aligned_seq in zip(missing.items(), computed):
+        aligned_seqs[seq] = write_cached(key, aligned_seq)
+    return aligned_seqs
@@ -1,34 +1,31 @@
+import contextlib
 import functools
-import re
+import hashlib
+import tempfile
+import threading
+import time
 
-import pandas as pd
-from flask import Flask, render_template, request, jsonify, Response
+from flask import Blueprint, Flask, current_app, render_template, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
-from Bio.Align import PairwiseAligner
 import json
 import os
 import numpy as np
-from numpy.lib.stride_tricks import sliding_window_view
 
+import alignment
 import bindline
+import cache
 import consts
+import jobs
+import metrics
+import packing
 
-app = Flask(__name__)
-CORS(app)
-app.config['UPLOAD_FOLDER'] = consts.UPLOAD_DIR
-app.config['FASTA_FOLDER'] = consts.FASTA_DIR
-app.config['ESCORE_FOLDER'] = consts.ESCORE_DIR
+# the routes, registered on the app by create_app
+bp = Blueprint('bindline', __name__)
 
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-os.makedirs(app.config['FASTA_FOLDER'], exist_ok=True)
-os.makedirs(app.config['ESCORE_FOLDER'], exist_ok=True)
 
-escore_identifier = bindline.TFIdentifier(absolute_hypo_file=consts.ESCORE_MATRIX_PKL,
-                                          rank_hypo_file=consts.ESCORE_RANK_MATRIX_PKL)
-zscore_identifier = bindline.TFIdentifier(absolute_hypo_file=consts.ZSCORE_MATRIX_PKL,
-                                          rank_hypo_file=consts.ESCORE_RANK_MATRIX_PKL)
-iscore_identifier = bindline.TFIdentifier(absolute_hypo_file=consts.ISCORE_MATRIX_PKL,
-                                          rank_hypo_file=consts.ESCORE_RANK_MATRIX_PKL)
+def matrix_path(npy_path, pkl_path):
+    # prefer the memory mapped store, fall back to the pickles of older builds
+    return npy_path if os.path.exists(npy_path) else pkl_path
 
 
 def recursive_dir(path):
@@ -37,13 +34,13 @@ def recursive_dir(path):
 
 
 # List existing files in the upload directory
-@app.route('/list-files/<filetype>', methods=['GET'])
+@bp.route('/list-files/<filetype>', methods=['GET'])
 def list_files(filetype):
     # fasta files in "fasta" directory, escore files in "escore" directory
     if filetype == 'fasta':
-        files = recursive_dir(app.config['FASTA_FOLDER'])
+        files = recursive_dir(current_app.config['FASTA_FOLDER'])
     elif filetype == 'escore':
-        files = recursive_dir(app.config['ESCORE_FOLDER'])
+        files = [f for f in recursive_dir(current_app.config['ESCORE_FOLDER']) if not bindline.is_mer8_sidecar(f)]
     else:
         files = []
     return jsonify(files)
@@ -74,23 +71,7 @@ def get_x_vals_from_aligned_seq(aligned_seq):
     return x_vals
 
 
-@functools.lru_cache(maxsize=128)
-def align_sequences(ref_seq, seq):
-    aligner = PairwiseAligner()
-    aligner.match_score = 2
-    aligner.mismatch_score = -1
-    aligner.target_open_gap_score = -1e6  # Extremely high penalty for opening gaps in the reference
-    aligner.target_extend_gap_score = -1e6  # Extremely high penalty for extending gaps in the reference
-    aligner.query_open_gap_score = -0.5
-    aligner.query_extend_gap_score = -0.1
-    alignments = aligner.align(ref_seq, seq)
-    # in places the ref is -, turn the seq to lowercase
-    aligned_seq = ''.join([c.lower() if alignments[0][0][i] == '-' else c for i, c in enumerate(alignments[0][1])])
-    return aligned_seq
-
-
-def align_scores(ref_seq, seq, scores):
-    aligned_seq = align_sequences(ref_seq, seq)
+def gap_scores(aligned_seq, seq, scores):
     # return the scores with gaps in the same positions
     aligned_scores = []
     j = 0
@@ -98,8 +79,26 @@ def align_scores(ref_seq, seq, scores):
         is_gap = aligned_seq[i] == '-'
         aligned_scores.append(None if is_gap or j >= len(scores) else scores[j])
         j += int(not is_gap)
-    aligned_pos = get_x_vals_from_aligned_seq(aligned_seq)
-    return aligned_seq, aligned_pos, aligned_scores
+    return aligned_scores
+
+
+def align_to_ref(sequences, ref_name):
+    # the aligned sequences and their x positions, by the name of the sequence
+    aligned = alignment.align_all(sequences[ref_name], sequences.values())
+    aligned_seqs = {name: aligned[seq] for name, seq in sequences.items()}
+    aligned_positions = {name: get_x_vals_from_aligned_seq(aligned_seq) for name, aligned_seq in aligned_seqs.items()}
+    return aligned_seqs, aligned_positions
+
+
+def parse_mutant_name(name):
+    # (kind, pos, base) of a mutant named by get_all_mutants
+    name = name.split('_')[-1]
+    typ = name[0]
+    if typ in ('m', 'i'):
+        return typ, int(name[1:-1]), name[-1]
+    if typ == 'd':
+        return typ, int(name[1:]), None
+    raise ValueError("Invalid mutation type.")
 
 
 def align_sequences_by_name(name, seq):
@@ -135,22 +134,22 @@ def align_scores_by_name(name, seq, scores):
     raise ValueError("Invalid mutation type.")
 
 
-@app.route('/')
+@bp.route('/')
 def index():
     return render_template('index.html')
 
 
-@app.route('/sequences', methods=['POST'])
+@bp.route('/sequences', methods=['POST'])
 def get_sequences():
     fasta_file = request.files.get('fasta')  # Get uploaded file, if any
     existing_fasta = request.form.get('existing_fasta')  # Get existing file if selected
 
     # Determine the FASTA file to use
     if fasta_file:
-        fasta_path = os.path.join(app.config['FASTA_FOLDER'], fasta_file.filename)
+        fasta_path = os.path.join(current_app.config['FASTA_FOLDER'], fasta_file.filename)
         fasta_file.save(fasta_path)  # Save the uploaded file
     elif existing_fasta:
-        fasta_path = os.path.join(app.config['FASTA_FOLDER'], existing_fasta)
+        fasta_path = os.path.join(current_app.config['FASTA_FOLDER'], existing_fasta)
     else:
         return jsonify({'error': 'No FASTA file provided.'}), 400
 
@@ -166,37 +165,135 @@ def get_sequences():
     return jsonify({'sequences': sequences})
 
 
-def get_score_file(score_path, file_type):
-    with open(score_path, 'r') as f:
-        if file_type == 'escore':
-            score = bindline.UniProbeEScoreFile(f.read())
-        elif file_type == 'zscore':
-            score = bindline.UniProbeZScoreFile(f.read())
-        elif file_type == 'iscore':
-            score = bindline.UniProbeIScoreFile(f.read())
-        else:
-            raise ValueError("Invalid file type selected.")
-    return score
+SCORE_TABLE_TYPES = {
+    'escore': ('E', bindline.EScoreTable),
+    'zscore': ('Z', bindline.ZScoreTable),
+    'iscore': ('I', bindline.IScoreTable),
+}
 
 
 def float_or_none(value):
     return float(value) if value is not None else None
 
 
+@functools.lru_cache(maxsize=None)
+def load_identifier(file_type):
+    return bindline.TFIdentifier(
+        absolute_hypo_file=get_score_matrix_path(file_type),
+        rank_hypo_file=matrix_path(consts.ESCORE_RANK_MATRIX_NPY, consts.ESCORE_RANK_MATRIX_PKL))
+
+
+# the identifiers are loaded by the first request which needs them (or by warmup), once
+_identifiers_lock = threading.Lock()
+
+
 def get_identifier_by_type(file_type):
-    if file_type == 'escore':
-        return escore_identifier
-    elif file_type == 'zscore':
-        return zscore_identifier
-    elif file_type == 'iscore':
-        return iscore_identifier
-    else:
+    if file_type not in SCORE_MATRIX_PATHS:
         raise ValueError("Invalid file type selected.")
+    with _identifiers_lock:
+        return load_identifier(file_type)
+
+
+def load_score_table(file_path, file_type):
+    score_type, table_type = SCORE_TABLE_TYPES[file_type]
+    # all the score types are parsed once and kept in a memory mapped sidecar of the file
+    arrays = bindline.load_mer8_arrays(file_path)
+    if score_type not in arrays:
+        raise ValueError(f'No {score_type} score in the table')
+    return table_type.from_array(arrays[score_type])
+
+
+# parsed tables, bounded by the size of their score arrays
+table_cache = cache.BoundedCache(consts.TABLE_CACHE_BYTES, sizeof=lambda table: table.array.nbytes)
 
 
-@functools.lru_cache(maxsize=1000)
 def get_score_table(file_path, file_type):
-    return next(get_score_file(file_path, file_type).parse_tables())
+    if file_type not in SCORE_TABLE_TYPES:
+        raise ValueError("Invalid file type selected.")
+    # a file re-uploaded with the same name has a new mtime or size, so it is parsed again
+    stat = os.stat(file_path)
+    key = (file_path, file_type, stat.st_mtime_ns, stat.st_size)
+    if key not in table_cache:
+        table_cache.discard(lambda k: k[:2] == key[:2] and k != key)
+    return table_cache.get_or_create(key, lambda: load_score_table(file_path, file_type))
+
+
+SCORE_MATRIX_PATHS = {
+    'escore': (consts.ESCORE_MATRIX_NPY, consts.ESCORE_MATRIX_PKL),
+    'zscore': (consts.ZSCORE_MATRIX_NPY, consts.ZSCORE_MATRIX_PKL),
+    'iscore': (consts.ISCORE_MATRIX_NPY, consts.ISCORE_MATRIX_PKL),
+}
+
+
+def get_score_matrix_path(file_type):
+    if file_type not in SCORE_MATRIX_PATHS:
+        raise ValueError("Invalid file type selected.")
+    return matrix_path(*SCORE_MATRIX_PATHS[file_type])
+
+
+@functools.lru_cache(maxsize=1000)
+def get_matrix_table(score_matrix_path, row):
+    # the table is a view of the mapped matrix row
+    return bindline.EScoreTable.from_array(bindline.load_score_matrix(score_matrix_path).row_values(row))
+
+
+def get_matrix_rows(score_files, file_type):
+    # rows of the score files in the prebuilt matrix, for the files which did not change since their row was written.
+    # the files without a filled row are scored by their own tables (which fail on a missing score type)
+    score_matrix_path = get_score_matrix_path(file_type)
+    score_matrix = bindline.load_score_matrix(score_matrix_path)
+
+    rows = {}
+    for score_file in score_files:
+        score_path = os.path.join(current_app.config['ESCORE_FOLDER'], score_file)
+        try:
+            row = score_matrix.row(score_file)
+        except KeyError:
+            continue
+        if (os.path.exists(score_path) and os.path.getmtime(score_path) <= score_matrix.row_mtime(row)
+                and score_matrix.row_filled(row)):
+            rows[score_file] = row
+    return score_matrix_path, rows
+
+
+def get_score_tables(score_files, file_type, matrix_rows=None):
+    # tables of the score files, views of the prebuilt matrix rows where they are up to date.
+    # matrix_rows is the result of get_matrix_rows, if the caller already looked the rows up
+    score_matrix_path, rows = matrix_rows or get_matrix_rows(score_files, file_type)
+    return {score_file: get_matrix_table(score_matrix_path, rows[score_file]) if score_file in rows
+            else get_score_table(os.path.join(current_app.config['ESCORE_FOLDER'], score_file), file_type)
+            for score_file in score_files}
+
+
+def score_files_seqs(score_files, file_type, sequences):
+    # score all the sequences against all the score files.
+    # files with an up-to-date row in the prebuilt matrix are scored together by a single gather,
+    # the others by their own tables. returns {score file: (table, {seq name: (sequence, scores)})}
+    matrix_rows = score_matrix_path, rows = get_matrix_rows(score_files, file_type)
+    blocks = bindline.score_matrix_rows(bindline.load_score_matrix(score_matrix_path), list(rows.values()),
+                                        list(sequences.values()))
+    block_rows = {score_file: i for i, score_file in enumerate(rows)}
+    files_scores = {}
+    for score_file, table in get_score_tables(score_files, file_type, matrix_rows).items():
+        if score_file in block_rows:
+            i = block_rows[score_file]
+            files_scores[score_file] = table, {name: (seq, block[i]) for (name, seq), block in zip(sequences.items(), blocks)}
+        else:
+            files_scores[score_file] = table, table.score_seqs(sequences)
+    return files_scores
+
+
+def score_files_mutants(score_files, file_type, sequences, ref_name):
+    # score the reference and all its single mutants (see get_all_mutants) against all the score files.
+    # only the windows each mutation changes are rescored, and the mutant scores are built lazily
+    mutations = {name: parse_mutant_name(name) for name in sequences if name != ref_name}
+    scans = {}
+    files_scores = {}
+    for score_file, table in get_score_tables(score_files, file_type).items():
+        if table.mer not in scans:
+            scans[table.mer] = bindline.MutationScan(sequences[ref_name], mutations, table.mer)
+        files_scores[score_file] = table, scans[table.mer].scores(table, sequences, ref_name)
+    return files_scores
 
 
 def get_thresholds(request):
@@ -209,81 +306,208 @@ def get_thresholds(request):
     return selected_threshold, ranks_threshold
 
 
-@app.route('/find-binding-sites', methods=['GET'])
+@contextlib.contextmanager
+def timed(timings, stage):
+    start = time.perf_counter()
+    yield
+    timings[stage] = time.perf_counter() - start
+
+
+def log_timings(endpoint, timings):
+    current_app.logger.debug('%s: %s', endpoint, ', '.join(f'{stage} {seconds * 1000:.1f}ms' for stage, seconds in timings.items()))
+    if metrics.enabled:
+        for stage, seconds in timings.items():
+            metrics.observe_stage(f'{endpoint}.{stage.replace(" ", "_")}', seconds)
+
+
+BODY_MIMETYPES = {'json': 'application/json', 'packed': packing.PACKED_MIMETYPE}
+
+
+def requested_body_format():
+    # JSON, or packed (see packing.py) if the client asks for it
+    return 'packed' if packing.PACKED_MIMETYPE in request.headers.get('Accept', '') else 'json'
+
+
+@metrics.timed('serialize')
+def serialize_plot_data(plot_data, body_format, allow_nan=True):
+    if body_format == 'packed':
+        return packing.dumps(plot_data)
+    return current_app.json.dumps(plot_data, allow_nan=allow_nan).encode()
+
+
+def body_response(body, body_format):
+    # compressed by an encoding the client accepts
+    with metrics.span('compress'):
+        body, content_encoding = packing.compress(body, request.accept_encodings)
+    response = Response(body, mimetype=BODY_MIMETYPES[body_format])
+    if content_encoding:
+        response.headers['Content-Encoding'] = content_encoding
+    response.vary.update(['Accept', 'Accept-Encoding'])
+    return response
+
+
+def plot_data_response(plot_data, allow_nan=True):
+    body_format = requested_body_format()
+    return body_response(serialize_plot_data(plot_data, body_format, allow_nan), body_format)
+
+
+# bump when the plot data of the analyses changes, the cached results are not used anymore
+RESULT_CACHE_VERSION = 1
+result_cache = cache.TieredCache(consts.RESULT_CACHE_DIR, consts.RESULT_CACHE_BYTES, consts.RESULT_CACHE_DISK_BYTES)
+
+
+@functools.lru_cache(maxsize=4096)
+def hash_file(path, mtime_ns, size):
+    # hashed again only when the mtime or size of the file changes
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 ** 2), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def score_file_hash(score_file):
+    path = os.path.join(current_app.config['ESCORE_FOLDER'], score_file)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return hash_file(path, stat.st_mtime_ns, stat.st_size)
+
+
+def analysis_fingerprint(analysis, file_type, sequences, ref_name, score_files, selected_threshold, ranks_threshold,
+                         identifier_fingerprint=None):
+    # identifies the base plot data of an analysis by all its inputs: the content of the score files,
+    # and for the binding sites the matrices the identifier was loaded with
+    inputs = [RESULT_CACHE_VERSION, analysis, file_type, list(sequences.items()), ref_name,
+              [(score_file, score_file_hash(score_file)) for score_file in score_files],
+              selected_threshold, ranks_threshold, identifier_fingerprint, alignment.ALIGNER_KEY]
+    return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()
+
+
+def result_key(fingerprint, view, body_format):
+    return hashlib.sha256(f'{fingerprint}.{view}.{body_format}'.encode()).hexdigest()
+
+
+def cache_base_plot_data(fingerprint, plot_data, allow_nan=True):
+    # the base plot data is cached as JSON, the other views and formats are made from it
+    return result_cache.put(result_key(fingerprint, 'base', 'json'), serialize_plot_data(plot_data, 'json', allow_nan))
+
+
+def spool_entry(spool, key, value):
+    # an item of a JSON object in a temporary file, the object is closed by cache_spooled_plot_data
+    spool.write(f'{", " if spool.tell() else ""}{current_app.json.dumps(key)}: {current_app.json.dumps(value)}'.encode())
+
+
+def cache_spooled_plot_data(fingerprint, plot_data, spools):
+    # the base plot data with the {field: spool} entries of the files, cached one chunk at a time
+    dumps = current_app.json.dumps
+
+    def chunks():
+        yield ('{' + ', '.join(f'{dumps(key)}: {dumps(value)}' for key, value in plot_data.items())).encode()
+        for field, spool in spools.items():
+            yield f', {dumps(field)}: {{'.encode()
+            spool.seek(0)
+            yield from iter(lambda: spool.read(1024 ** 2), b'')
+            yield b'}'
+        yield b'}'
+    result_cache.put_chunks(result_key(fingerprint, 'base', 'json'), chunks())
+
+
+def cached_plot_data(fingerprint, compute, allow_nan=True):
+    # the base plot data, from its cached body or by compute()
+    body = result_cache.get(result_key(fingerprint, 'base', 'json'))
+    if body is not None:
+        return json.loads(body)
+    plot_data = compute()
+    cache_base_plot_data(fingerprint, plot_data, allow_nan)
+    return plot_data
+
+
+def cached_plot_data_response(fingerprint, compute, derive=None, allow_nan=True):
+    # the response of the view of the plot data, from its cached body.
+    # derive(plot_data) makes the derived view from the base plot data in place, the base is computed only if it was
+    # not cached. returns None on a miss if compute() returns None, for the caller to compute the result by itself
+    body_format = requested_body_format()
+    view_key = result_key(fingerprint, 'diff' if derive else 'base', body_format)
+    body = result_cache.get(view_key)
+    if body is None:
+        base_key = result_key(fingerprint, 'base', 'json')
+        body = result_cache.get(base_key)
+        if body is not None:
+            plot_data = json.loads(body)
+        else:
+            plot_data = compute()
+            if plot_data is None:
+                return None
+            body = cache_base_plot_data(fingerprint, plot_data, allow_nan)
+        if view_key != base_key:
+            if derive:
+                derive(plot_data)
+            body = result_cache.put(view_key, serialize_plot_data(plot_data, body_format, allow_nan))
+    return body_response(body, body_format)
+
+
+@bp.route('/find-binding-sites', methods=['GET'])
 def find_binding_sites():
     file_type = request.form['file_type']
     sequences = json.loads(request.form.get('sequences'))
     selected_threshold, ranks_threshold = get_thresholds(request)
     ref_name = request.form['ref_name']
-    # identify by both identifiers, and combine
-    identifier = get_identifier_by_type(file_type)
+    timings = {}
+    # the binding sites are searched in the identified files, the result is cached by their content
+    with timed(timings, 'identify'):
+        identifier = get_identifier_by_type(file_type)
+        identified_TFs, identified_files = identify_files(identifier, sequences, selected_threshold, ranks_threshold)
+    fingerprint = analysis_fingerprint('binding_sites', file_type, sequences, ref_name, identified_files,
+                                       selected_threshold, ranks_threshold, identifier.fingerprint)
+    return cached_plot_data_response(
+        fingerprint, lambda: binding_sites_plot_data(
+            file_type, sequences, ref_name, identified_TFs, identified_files, timings),
+        derive=binding_sites_diff_view if request.form['show_diff_only'] == 'true' else None, allow_nan=False)
+
+
+def identify_files(identifier, sequences, selected_threshold, ranks_threshold):
+    # identify by both identifiers, and combine.
+    # identified_TFs[seq_name] is a tuple where first value is the sequence
+    # and the second is the list of lists of file paths identified at each position
     identified_TFs = identifier(sequences, absolute_threshold=selected_threshold, rank_threshold=ranks_threshold)
+    # the unique identified files, in the order they were first identified
+    identified_files = list(dict.fromkeys(
+        file for _, positions in identified_TFs.values() for files in positions for file in files))
+    return identified_TFs, identified_files
 
-    # Extract unique file paths of identified TFs
-    # identified_TFs[seq_name] is a tuple where first value is the sequence
-    # and the second is the list of lists of file paths
-    identified_unq_files = sum(sum(map(lambda s: s[1], identified_TFs.values()), []), [])
 
-    # Get the tables for each identified file
-    identified_tables = {}
-    identified_binding_sites = {}
-    for file in identified_unq_files:
-        file_path = os.path.join(app.config['ESCORE_FOLDER'], file)
-        _, _, identified_tables[file] = get_score_table(file_path, file_type)
-        score = identified_tables[file].score_seqs(sequences)
-
-        identified_binding_sites[file] = {}
-        for seq_name in identified_TFs:
-            curr_bs = [score[seq_name][1][i] if file in pos_ls else None
-                       for i, pos_ls in enumerate(identified_TFs[seq_name][1])]
-            _, _, identified_binding_sites[file][seq_name] = align_scores(sequences[ref_name], sequences[seq_name], curr_bs)
-
-    # Compute the scores for each identified transcription factor (TF) across all sequences.
-    # The dictionary has the following structure:
-    # {
-    #   identified file path 1: {
-    #       seq name 1: (sequence, array of scores),
-    #       seq name 2: (sequence, array of scores)
-    #   },
-    #   identified file path 2: {
-    #       seq name 1: (sequence, array of scores),
-    #       seq name 2: (sequence, array of scores)
-    #   }
-    # }
+def binding_sites_plot_data(file_type, sequences, ref_name, identified_TFs, identified_files, timings):
+    # Compute the scores for each identified transcription factor (TF) across all sequences, once:
+    # {identified file path: (table, {seq name: (sequence, array of scores)})}
+    with timed(timings, 'score'):
+        files_scores = score_files_seqs(identified_files, file_type, sequences)
+
+    # the alignment of each sequence to the reference is shared by all the files
+    with timed(timings, 'align'):
+        aligned_seqs, aligned_positions = align_to_ref(sequences, ref_name) if files_scores else ({}, {})
+
     max_scores = {}
     identified_scores = {}
+    identified_binding_sites = {}
     binding_sites, gaps, insertions = {}, {}, {}
-    aligned_seqs = {}
-    aligned_positions = {}
-
-    for score_file, table in identified_tables.items():
-        scores_dict = table.score_seqs(sequences)
-        max_scores[score_file] = table.max_score()
-        identified_scores[score_file] = curr_aligned_scores = {}
-        ref_seq, ref_scores = scores_dict[ref_name]
-
-        binding_sites[score_file] = curr_binding_sites = {}
-        gaps[score_file] = curr_gaps = {}
-        insertions[score_file] = curr_insertions = {}
-        for name, (sequence_str, sequence_scores) in scores_dict.items():
-            # curr_aligned_scores[name] = align_sequences(ref_scores, sequence_scores)
-            aligned_seqs[name], aligned_positions[name], curr_aligned_scores[name] = (
-                align_scores(ref_seq, sequence_str, sequence_scores))
-            curr_binding_sites[name], curr_gaps[name], curr_insertions[name] = (
-                get_binding_sites(identified_binding_sites[score_file][name],
-                                  aligned_seqs[name], table.mer, aligned_positions[name]))
-
-    if request.form['show_diff_only'] == 'true':
-        show_diff_only(binding_sites, ref_name)
-        # remove the sequences that have no binding sites except of the ref
-        for file, bss in binding_sites.items():
-            for seq_name, bs in bss.items():
-                if seq_name != ref_name and len(bs) == 0:
-                    del identified_scores[file][seq_name], identified_binding_sites[file][seq_name], gaps[file][seq_name]
-            binding_sites[file] = {k: v for k, v in bss.items() if v and k != ref_name}
-            if not binding_sites[file]:
-                del identified_scores[file], identified_binding_sites[file], gaps[file], max_scores[file]
-        binding_sites = {k: v for k, v in binding_sites.items() if v}
+    with timed(timings, 'binding sites'):
+        for score_file, (table, scores_dict) in files_scores.items():
+            max_scores[score_file] = table.max_score()
+            identified_scores[score_file] = curr_aligned_scores = {}
+            identified_binding_sites[score_file] = curr_identified = {}
+            binding_sites[score_file] = curr_binding_sites = {}
+            gaps[score_file] = curr_gaps = {}
+            insertions[score_file] = curr_insertions = {}
+            for name, (sequence_str, sequence_scores) in scores_dict.items():
+                # the scores only where the file was identified
+                identified = [sequence_scores[i] if score_file in files else None
+                              for i, files in enumerate(identified_TFs[name][1])]
+                curr_aligned_scores[name] = gap_scores(aligned_seqs[name], sequence_str, sequence_scores)
+                curr_identified[name] = gap_scores(aligned_seqs[name], sequence_str, identified)
+                curr_binding_sites[name], curr_gaps[name], curr_insertions[name] = get_binding_sites(
+                    curr_identified[name], aligned_seqs[name], table.mer, aligned_positions[name])
 
     plot_data = {
         'ref_name': ref_name,
@@ -297,13 +521,27 @@ def find_binding_sites():
         'insertions': insertions,
         'gaps': gaps,
     }
+    log_timings('find-binding-sites', timings)
+    return plot_data
+
 
-    print(plot_data)
+def binding_sites_diff_view(plot_data):
+    # leave only the binding sites which differ from the reference, in place
+    ref_name = plot_data['ref_name']
+    identified_scores, identified_binding_sites = plot_data['aligned_scores'], plot_data['highest_values']
+    binding_sites, gaps, max_scores = plot_data['binding_sites'], plot_data['gaps'], plot_data['max_scores']
 
-    return Response(
-        json.dumps(plot_data, allow_nan=False),
-        mimetype='application/json'
-    )
+    binding_site_counts = show_diff_only(binding_sites, ref_name)
+    # remove the sequences that have no binding sites except of the ref
+    for file, bss in binding_sites.items():
+        for seq_name, bs in bss.items():
+            if seq_name != ref_name and len(bs) == 0:
+                del identified_scores[file][seq_name], identified_binding_sites[file][seq_name], gaps[file][seq_name]
+        binding_sites[file] = {k: v for k, v in bss.items() if v and k != ref_name}
+        if not binding_sites[file]:
+            del identified_scores[file], identified_binding_sites[file], gaps[file], max_scores[file]
+    plot_data['binding_sites'] = binding_sites = {k: v for k, v in binding_sites.items() if v}
+    plot_data['binding_site_counts'] = {file: binding_site_counts[file] for file in binding_sites}
 
 
 def get_all_point_mutations(sequence):
@@ -347,7 +585,7 @@ def get_score_files(request):
         # save them (it's a list of files)
         score_files = request.files.getlist('e_score')
         for score_file in score_files:
-            score_path = os.path.join(app.config['ESCORE_FOLDER'], score_file.filename)
+            score_path = os.path.join(current_app.config['ESCORE_FOLDER'], score_file.filename)
             score_file.save(score_path)
         # take their names
         return [f.filename for f in score_files]
@@ -359,23 +597,50 @@ class BindingSiteParams:
     START, END, SEQ, BS_START, BS_END, IS_ADDED = range(6)
 
 
-def does_equivalent_bs_exist(bs, binding_sites):
-    return (bs[BindingSiteParams.SEQ].replace('-', '') in map(lambda x: x[BindingSiteParams.SEQ], binding_sites) or
-            ((bs[BindingSiteParams.START], bs[BindingSiteParams.END]) in
-             map(lambda x: (x[BindingSiteParams.START], x[BindingSiteParams.END]), binding_sites)))
+class BindingSiteIndex:
+    # binding sites hashed by their sequence and by their aligned (start, end), to find equivalent sites at once
+    def __init__(self, binding_sites):
+        self._seqs = {bs[BindingSiteParams.SEQ] for bs in binding_sites}
+        self._positions = {(bs[BindingSiteParams.START], bs[BindingSiteParams.END]) for bs in binding_sites}
 
+    def __contains__(self, bs):
+        # an equivalent binding site has the same sequence (without gaps), or the same aligned position
+        return (bs[BindingSiteParams.SEQ].replace('-', '') in self._seqs or
+                (bs[BindingSiteParams.START], bs[BindingSiteParams.END]) in self._positions)
 
-def find_significant_mutations():
-    file_type = request.form['file_type']
+
+def significant_mutations_args(request):
+    # the arguments of significant_mutations_plot_data from the request form, the uploaded score files are saved
     sequences = json.loads(request.form.get('sequences'))
     assert len(sequences) == 1, "Only one sequences are allowed for this analysis."  # checked in js
     selected_threshold, ranks_threshold = get_thresholds(request)
     assert selected_threshold is not None or ranks_threshold is not None, \
         "Either score or rank threshold must be provided."   # checked in js
+    return {
+        'file_type': request.form['file_type'],
+        'sequences': sequences,
+        'ref_name': request.form['ref_name'],
+        'score_files': get_score_files(request),
+        'selected_threshold': selected_threshold,
+        'ranks_threshold': ranks_threshold,
+    }
 
-    ref_name = request.form['ref_name']
+
+def significant_mutations_fingerprint(args):
+    return analysis_fingerprint('significant_mutations', args['file_type'], args['sequences'], args['ref_name'],
+                                args['score_files'], args['selected_threshold'], args['ranks_threshold'])
+
+
+def find_significant_mutations():
+    args = significant_mutations_args(request)
+    return cached_plot_data_response(significant_mutations_fingerprint(args),
+                                     lambda: significant_mutations_plot_data(**args), allow_nan=False)
+
+
+def significant_mutations_plot_data(file_type, sequences, ref_name, score_files, selected_threshold, ranks_threshold,
+                                    progress=None):
+    # progress(done, total) is called before each score file, and once all of them are done
     sequences = get_all_mutants(*next(iter(sequences.items())))
-    score_files = get_score_files(request)
 
     aligned_scores = {}
     aligned_seqs = {}
@@ -385,12 +650,10 @@ def find_significant_mutations():
     binding_sites = {}
     gaps, insertions = {}, {}
 
-    for score_file in score_files:
-        score_path = os.path.join(app.config['ESCORE_FOLDER'], score_file)
-
-        name, motif, table = get_score_table(score_path, file_type)
-        scores_dict = table.score_seqs(sequences)
-
+    files_scores = score_files_mutants(score_files, file_type, sequences, ref_name)
+    for done, (score_file, (table, scores_dict)) in enumerate(files_scores.items()):
+        if progress:
+            progress(done, len(files_scores))
         max_scores[score_file] = table.max_score()
         aligned_scores[score_file] = curr_aligned_scores = {}
 
@@ -406,35 +669,34 @@ def find_significant_mutations():
         # reduce binding sites
         # leave only one occurrence of each threesome
         bs_set = set()
-        for name in binding_sites[score_file]:
-            indices_to_remove = []
-            for i, bs in enumerate(binding_sites[score_file][name]):
-                if bs[BindingSiteParams.SEQ].replace('-', '') in bs_set:
-                    indices_to_remove.append(i)
-                else:
+        for sites in binding_sites[score_file].values():
+            unique_sites = []
+            for bs in sites:
+                if bs[BindingSiteParams.SEQ].replace('-', '') not in bs_set:
                     bs_set.add(bs[BindingSiteParams.SEQ])
-            for i in reversed(indices_to_remove):
-                del binding_sites[score_file][name][i]
-
-        # create MPRA-like data
-        mutants_effect = get_all_mutants_effect(aligned_scores[score_file], sequences, ref_name, mer=table.mer)
+                    unique_sites.append(bs)
+            sites[:] = unique_sites
 
         curr_binding_sites = binding_sites[score_file]
+        ref_binding_sites = BindingSiteIndex(curr_binding_sites[ref_name])
         for name in sequences.keys():
             if name == ref_name:
                 continue
-            indices_to_remove = []
-            for i, bs in enumerate(curr_binding_sites[name]):
-                if does_equivalent_bs_exist(bs, binding_sites[score_file][ref_name]):
-                    indices_to_remove.append(i)
-            if len(indices_to_remove) == len(curr_binding_sites[name]):
+            different_sites = [bs for bs in curr_binding_sites[name] if bs not in ref_binding_sites]
+            if not different_sites:
                 # remove from all dicts
                 del aligned_scores[score_file][name]
                 del highest_values[score_file][name], binding_sites[score_file][name], gaps[score_file][name], insertions[score_file][name]
             else:
                 # remove only the equivalent binding sites
-                for i in reversed(indices_to_remove):
-                    del curr_binding_sites[name][i]
+                curr_binding_sites[name][:] = different_sites
+
+    if progress:
+        progress(len(files_scores), len(files_scores))
+
+    # create MPRA-like data, of the last score file only (see MutationScan.substitution_effects)
+    mutants_effect = get_all_mutants_effect(next(reversed(files_scores.values()))[1].substitution_effects(),
+                                            sequences[ref_name]) if files_scores else []
 
     plot_data = {
         'ref_name': ref_name,
@@ -449,44 +711,151 @@ def find_significant_mutations():
         'gaps': gaps,
         'mutants_effect': mutants_effect,
     }
+    return plot_data
 
-    return Response(
-        json.dumps(plot_data, allow_nan=False),
-        mimetype='application/json'
-    )
 
+def get_all_mutants_effect(effects, ref_seq):
+    # {base: effect} of every substitution in each position of the reference, from its (L x 4) effects
+    return [{base: value for base, value in zip(consts.DNA_BASES, pos_effects) if base != ref_base}
+            for ref_base, pos_effects in zip(ref_seq, effects.tolist())]
 
-def sliding_max(scores, mer):
-    scores = np.pad(scores, (mer-1, mer-1), mode="constant", constant_values=-np.inf)
-    return np.max(sliding_window_view(scores, window_shape=mer), axis=1)
 
+job_queue = jobs.JobQueue(consts.JOB_WORKERS, consts.MAX_PENDING_JOBS, consts.JOB_RETENTION_SECONDS)
 
-def get_all_mutants_effect(aligned_scores, sequences, ref_name, mer):
-    ref_scores = aligned_scores[ref_name]
-    ref_effect = sliding_max(ref_scores, mer)
 
-    letters_to_index = {'A': 0, 'C': 1, 'G': 2, 'T': 3}
-    effects = np.zeros((len(sequences[ref_name]), len(letters_to_index)),)
-    for name, scores in aligned_scores.items():
-        if name == ref_name:
-            continue
-        mut = name.split('_')[-1]
-        if mut[0] != 'm':
-            continue
-        mut_base = mut[-1]
-        mut_pos = int(mut[1:-1])
-        # for each position, take the max of mer scores
-        effects[mut_pos, letters_to_index[mut_base]] = np.array(scores[max(mut_pos-mer+1, 0):mut_pos+1]).max()
-    df = pd.DataFrame(columns=['A', 'C', 'G', 'T'])
-    ref_seq = sequences[ref_name]
-    for i in range(len(ref_seq)):
-        df.loc[i] = effects[i] - ref_effect[i]
-    mutants_effect = df.to_dict(orient='index')
-    mutants_effect = [{k: v for k, v in mutants_effect[pos].items() if k != ref_seq[pos]} for pos in range(len(mutants_effect))]
-    return mutants_effect
-
-
-@app.route('/upload', methods=['POST'])
+def job_not_found(job_id):
+    return jsonify({'error': f'No job {job_id}, it may have expired.'}), 404
+
+
+@bp.route('/jobs', methods=['POST'])
+def submit_job():
+    # the analysis of the /upload form runs in the background, only the significant mutations search for now
+    if request.form.get('search_significant_mutations') != 'true':
+        return jsonify({'error': 'Only the significant mutations search runs as a job.'}), 400
+    args = significant_mutations_args(request)
+    fingerprint = significant_mutations_fingerprint(args)
+    app = current_app._get_current_object()
+
+    def work(job):
+        # the job thread runs outside of the request, in the context of the app. the result of the job is only the
+        # fingerprint of its plot data, which is read from the result cache
+        with app.app_context():
+            cached_plot_data(
+                fingerprint, lambda: significant_mutations_plot_data(**args, progress=job.progress), allow_nan=False)
+        return fingerprint
+    try:
+        job = job_queue.submit('significant_mutations', work)
+    except jobs.QueueFull as e:
+        return jsonify({'error': str(e)}), 503
+    # the client follows the job by its status events if they are enabled, else by polling its status
+    return jsonify({**job.status(), 'events': consts.JOB_EVENTS}), 202
+
+
+@bp.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return job_not_found(job_id)
+    return jsonify(job.status())
+
+
+@bp.route('/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return job_not_found(job_id)
+    job.cancel()
+    return jsonify(job.status())
+
+
+@bp.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return job_not_found(job_id)
+    if job.state != jobs.DONE:
+        return jsonify({**job.status(), 'error': job.error or f'The job is {job.state}.'}), 409
+    response = cached_plot_data_response(job.result, lambda: None, allow_nan=False)
+    if response is None:
+        return jsonify({**job.status(), 'error': 'The result of the job was evicted from the cache, run it again.'}), 410
+    return response
+
+
+@bp.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    # server-sent events of the job status, on every change until the job is finished
+    if not consts.JOB_EVENTS:
+        return jsonify({'error': f'The job events are disabled, poll /jobs/{job_id} instead.'}), 404
+    job = job_queue.get(job_id)
+    if job is None:
+        return job_not_found(job_id)
+
+    def events():
+        version = None
+        while True:
+            version = job.wait(version, consts.JOB_EVENTS_INTERVAL_SECONDS)
+            yield f'data: {json.dumps(job.status())}\n\n'
+            if job.is_finished:
+                return
+    return Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+def upload_file_fields(should_show_binding_sites, should_show_diff_only):
+    # the plot data fields which have an entry for each score file
+    fields = ['aligned_scores', 'max_scores']
+    if should_show_binding_sites:
+        fields += ['highest_values', 'binding_sites', 'gaps', 'insertions']
+    if should_show_diff_only:
+        fields.append('binding_site_counts')
+    return fields
+
+
+def iter_files_plot_data(score_files, file_type, sequences, ref_name, aligned_seqs, aligned_positions,
+                         selected_threshold, ranks_threshold, chunk_files=None):
+    # yields (score file, {plot data field: entry of the file}) as soon as each file is done.
+    # the files are scored together in chunks of files, all at once if no chunk size is given
+    should_show_binding_sites = selected_threshold is not None or ranks_threshold is not None
+    chunk_files = chunk_files or max(len(score_files), 1)
+    for i in range(0, len(score_files), chunk_files):
+        for score_file, (table, scores_dict) in score_files_seqs(score_files[i:i + chunk_files], file_type, sequences).items():
+            data = {
+                'aligned_scores': {name: gap_scores(aligned_seqs[name], sequence_str, sequence_scores)
+                                   for name, (sequence_str, sequence_scores) in scores_dict.items()},
+                'max_scores': table.max_score(),
+            }
+            if should_show_binding_sites:
+                data['highest_values'], data['binding_sites'], data['gaps'], data['insertions'] = find_highest_values_and_binding_sites(
+                    data['aligned_scores'], aligned_positions, sequences, ref_name, selected_threshold, ranks_threshold, table)
+            yield score_file, data
+
+
+def upload_diff_view(plot_data):
+    # leave only the binding sites which differ from the reference, in place
+    plot_data['binding_site_counts'] = show_diff_only(plot_data['binding_sites'], plot_data['ref_name'])
+
+
+def upload_diff_entries(score_file, data, ref_name):
+    # the entries of the score file in the diff view, its base entries are left as they are
+    # (show_diff_only replaces the sites of each sequence by new lists)
+    binding_sites = dict(data['binding_sites'])
+    counts = show_diff_only({score_file: binding_sites}, ref_name)
+    return {**data, 'binding_sites': binding_sites, 'binding_site_counts': counts[score_file]}
+
+
+def stream_plot_data(shared_plot_data, files_plot_data):
+    # NDJSON lines: the shared fields, one line for each score file with its entries, and a closing line
+    yield current_app.json.dumps(shared_plot_data) + '\n'
+    try:
+        for score_file, data in files_plot_data:
+            yield current_app.json.dumps({'file': score_file, 'data': data}) + '\n'
+    except Exception as e:
+        current_app.logger.exception('Streaming the plot data failed')
+        yield current_app.json.dumps({'error': str(e)}) + '\n'
+        return
+    yield current_app.json.dumps({'done': True}) + '\n'
+
+
+@bp.route('/upload', methods=['POST'])
 def upload_files():
     if request.form['search_binding_sites'] == 'true':
         return find_binding_sites()
@@ -498,54 +867,57 @@ def upload_files():
     score_files = get_score_files(request)
     ref_name = request.form['ref_name']
 
-    aligned_scores = {}
-    aligned_seqs = {}
-    aligned_positions = {}
-    max_scores = {}
-
     selected_threshold, ranks_threshold = get_thresholds(request)
     should_show_binding_sites = selected_threshold is not None or ranks_threshold is not None
     should_show_diff_only = should_show_binding_sites and request.form['show_diff_only'] == 'true'
-    if should_show_binding_sites:
-        highest_values, binding_sites, gaps, insertions = {}, {}, {}, {}
-
-    for score_file in score_files:
-        score_path = os.path.join(app.config['ESCORE_FOLDER'], score_file)
-
-        name, motif, table = get_score_table(score_path, file_type)
-        scores_dict = table.score_seqs(sequences)
-
-        max_scores[score_file] = table.max_score()
-        aligned_scores[score_file] = curr_aligned_scores = {}
-        ref_seq, ref_scores = scores_dict[ref_name]
-
-        for name, (sequence_str, sequence_scores) in scores_dict.items():
-            aligned_seqs[name], aligned_positions[name], curr_aligned_scores[name] = align_scores(ref_seq, sequence_str, sequence_scores)
-
-        if should_show_binding_sites:
-            highest_values[score_file], binding_sites[score_file], gaps[score_file], insertions[score_file] = find_highest_values_and_binding_sites(
-                aligned_scores[score_file], aligned_positions, sequences, ref_name, selected_threshold, ranks_threshold, table)
-
-    if should_show_diff_only:
-        show_diff_only(binding_sites, ref_name)
-
-    plot_data = {
-        'ref_name': ref_name,
-        'sequence_strs': sequences,
-        'aligned_seqs': aligned_seqs,
-        'aligned_scores': aligned_scores,
-        'aligned_positions': aligned_positions,
-        'max_scores': max_scores,
-    }
-    if should_show_binding_sites:
-        plot_data.update({
-            'highest_values': highest_values,
-            'binding_sites': binding_sites,
-            'gaps': gaps,
-            'insertions': insertions
-        })
-
-    return jsonify(plot_data)
+    should_stream = request.form.get('stream') == 'true'
+    fingerprint = analysis_fingerprint('upload', file_type, sequences, ref_name, score_files, selected_threshold,
+                                       ranks_threshold)
+    derive = upload_diff_view if should_show_diff_only else None
+    base_fields = upload_file_fields(should_show_binding_sites, False)
+
+    def base_plot_data(chunk_files=None):
+        # (shared plot data, iterator of the entries of each score file)
+        # align all the sequences once, the alignments are shared by all the files
+        aligned_seqs, aligned_positions = align_to_ref(sequences, ref_name) if score_files else ({}, {})
+        plot_data = {
+            'ref_name': ref_name,
+            'sequence_strs': sequences,
+            'aligned_seqs': aligned_seqs,
+            'aligned_positions': aligned_positions,
+        }
+        return plot_data, iter_files_plot_data(score_files, file_type, sequences, ref_name, aligned_seqs,
+                                               aligned_positions, selected_threshold, ranks_threshold, chunk_files)
+
+    def compute():
+        plot_data, files_plot_data = base_plot_data()
+        plot_data.update({field: {} for field in base_fields})
+        for score_file, data in files_plot_data:
+            for field, entry in data.items():
+                plot_data[field][score_file] = entry
+        return plot_data
+
+    # a cached result is sent at once, streamed or not
+    response = cached_plot_data_response(fingerprint, compute if not should_stream else lambda: None, derive)
+    if response is not None:
+        return response
+
+    plot_data, files_plot_data = base_plot_data(consts.STREAM_CHUNK_FILES)
+    shared_plot_data = dict(plot_data)
+
+    def files_view_data():
+        # the base entries are spooled to a temporary file of each field, and cached once all the files are done
+        with contextlib.ExitStack() as stack:
+            spools = {field: stack.enter_context(tempfile.TemporaryFile()) for field in base_fields}
+            for score_file, data in files_plot_data:
+                for field, entry in data.items():
+                    spool_entry(spools[field], score_file, entry)
+                yield score_file, upload_diff_entries(score_file, data, ref_name) if should_show_diff_only else data
+            cache_spooled_plot_data(fingerprint, shared_plot_data, spools)
+
+    plot_data['fields'] = upload_file_fields(should_show_binding_sites, should_show_diff_only)
+    return Response(stream_with_context(stream_plot_data(plot_data, files_view_data())),
+                    mimetype='application/x-ndjson')
 
 
 def find_highest_values_and_binding_sites(aligned_scores, aligned_positions, sequences, ref_name,
@@ -561,70 +933,160 @@ def find_highest_values_and_binding_sites(aligned_scores, aligned_positions, seq
             scores, None
         ).tolist()
         binding_sites[name], gaps[name], insertions[name] = get_binding_sites(
-            highest_values[name], align_sequences(sequences[ref_name], sequences[name]), table.mer, aligned_positions[name])
+            highest_values[name], alignment.align_sequences(sequences[ref_name], sequences[name]), table.mer, aligned_positions[name])
 
     return highest_values, binding_sites, gaps, insertions
 
 
 def show_diff_only(binding_sites, ref_name):
+    # leave the binding sites added or removed relative to the reference.
+    # returns {protein file: number of added and removed sites}, to skip the files without differences
+    counts = {}
     for protein_file in binding_sites:
+        ref = binding_sites[protein_file][ref_name]
+        ref_index = BindingSiteIndex(ref)
         for input_seq in binding_sites[protein_file]:
             if input_seq != ref_name:
-                ref = binding_sites[protein_file][ref_name]
                 com = binding_sites[protein_file][input_seq]
-                added = [bs for bs in com if not does_equivalent_bs_exist(bs, ref)]
-                removed = [tuple(bs[:-1] + (False,)) for bs in ref if not does_equivalent_bs_exist(bs, com)]  # false means it removed
+                com_index = BindingSiteIndex(com)
+                added = [bs for bs in com if bs not in ref_index]
+                removed = [tuple(bs[:-1]) + (False,) for bs in ref if bs not in com_index]  # false means it removed
                 binding_sites[protein_file][input_seq] = added + removed
         # Delete the reference bs dict
         binding_sites[protein_file][ref_name] = []
+        counts[protein_file] = sum(map(len, binding_sites[protein_file].values()))
+    return counts
 
 
+@metrics.timed('get_binding_sites')
 def get_binding_sites(highest_values, seq, mer, aligned_positions):
-    # indices of the not None values in curr_highest_values[name], by numpy
-    bs = [i for i, value in enumerate(highest_values) if value is not None]
-    # for each binding site, get the start and end indices
-    # if there's a gap inside, calculate it
-    # if there are multiple binding sites in a row, merge them
-    curr_binding_sites = []
-    curr_gaps, curr_insertions = [], []
-    for i in range(len(bs)):
-        if i == 0 or (bs[i] - bs[i - 1] > 1 and any(c != '-' for c in seq[bs[i - 1] + 1:bs[i]])):
-            start = bs[i]
-        if i == len(bs) - 1 or (bs[i + 1] - bs[i] > 1 and any(c != '-' for c in seq[bs[i] + 1:bs[i + 1]])):
-            end = bs[i]
-            # count (mer - 1) non-gaps after the end
-            remain = mer - 1
-            for c in seq[end + 1:]:
-                end += 1
-                if c != '-':
-                    remain -= 1
-                    if remain == 0:
-                        break
-            bs_seq = seq[start:end + 1]
-            bs_start = len(seq[:start].replace('-', ''))  # start index in the original sequence
-            bs_end = bs_start + len(bs_seq.replace('-', '')) - 1
-            curr_binding_sites.append(
-                (aligned_positions[start], aligned_positions[end], bs_seq, bs_start, bs_end, True))
-            # add to curr_gaps all the '-' indices inside (start, end) intervals
-            curr_gaps += get_gaps(seq, start, end, aligned_positions)
-            curr_insertions += get_insertions(seq, start, end, aligned_positions)
+    # the sites are found on masks of the aligned sequence, computed once:
+    # consecutive hits with only gaps between them are merged to a site,
+    # and each site is extended by (mer - 1) bases after its last hit
+    chars = np.frombuffer(seq.encode('latin-1', 'replace'), dtype=np.uint8)
+    is_gap = chars == ord('-')
+    # the number of bases (non-gaps) before each index
+    bases_before = np.concatenate(([0], np.cumsum(~is_gap)))
+    hits = np.flatnonzero(np.array([value is not None for value in highest_values], dtype=bool))
+    if len(hits) == 0:
+        return [], [], []
+
+    new_site = np.concatenate(([True], bases_before[hits[1:]] > bases_before[hits[:-1] + 1]))
+    starts = hits[new_site]
+    ends = hits[np.append(new_site[1:], True)]
+    # the index of the last base of each site, or the end of the sequence if it has less bases
+    base_indices = np.flatnonzero(~is_gap)
+    last_base = bases_before[ends + 1] + mer - 2
+    ends = np.where(last_base < len(base_indices), base_indices[np.minimum(last_base, len(base_indices) - 1)],
+                    len(seq) - 1)
+
+    bs_starts = bases_before[starts].tolist()  # start indices in the original sequence
+    bs_ends = (bases_before[ends + 1] - 1).tolist()
+    curr_binding_sites = [(aligned_positions[start], aligned_positions[end], seq[start:end + 1], bs_start, bs_end, True)
+                          for start, end, bs_start, bs_end in zip(starts.tolist(), ends.tolist(), bs_starts, bs_ends)]
+    curr_gaps = get_gaps(starts, ends, aligned_positions, is_gap)
+    curr_insertions = get_insertions(seq, starts, ends, aligned_positions, (chars >= ord('a')) & (chars <= ord('z')))
     return curr_binding_sites, curr_gaps, curr_insertions
 
 
-def get_gaps(seq, start, end, aligned_positions):
-    # return start and end of '-' sequences in seq the interval [start, end]
-    # previous: return [aligned_positions[i] for i in range(start, end + 1) if seq[i] == '-']
-    return [(aligned_positions[match.start() + start], aligned_positions[match.end() + start - 1])
-            for match in re.finditer(r'-+', seq[start:end + 1])]
-
-
-def get_insertions(seq, start, end, aligned_positions):
-    # return start and end of lowercase sequences in seq the interval [start, end]
-    # previous: return [(aligned_positions[i], seq[i]) for i in range(start, end + 1) if seq[i].islower()]
-    return [(
-        (aligned_positions[match.start() + start] + aligned_positions[match.end() + start - 1]) / 2,
-        seq[match.start() + start:match.end() + start].upper())
-            for match in re.finditer(r'[a-z]+', seq[start:end + 1])]
+def clip_runs(mask, starts, ends):
+    # (start, end) of the runs of True in the mask inside the intervals [start, end], clipped to them.
+    # the ends are inclusive
+    edges = np.diff(np.concatenate(([False], mask, [False])).astype(np.int8))
+    run_starts, run_ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1) - 1
+    # the runs overlapping each interval
+    firsts, lasts = np.searchsorted(run_ends, starts), np.searchsorted(run_starts, ends, side='right')
+    counts = lasts - firsts
+    overlapping = np.repeat(np.arange(len(starts)), counts)
+    runs = np.arange(counts.sum()) + np.repeat(firsts - (np.cumsum(counts) - counts), counts)
+    return zip(np.maximum(run_starts[runs], starts[overlapping]).tolist(),
+               np.minimum(run_ends[runs], ends[overlapping]).tolist())
+
+
+def get_gaps(starts, ends, aligned_positions, is_gap):
+    # return start and end of '-' sequences in seq inside the [start, end] intervals
+    return [(aligned_positions[run_start], aligned_positions[run_end])
+            for run_start, run_end in clip_runs(is_gap, starts, ends)]
+
+
+def get_insertions(seq, starts, ends, aligned_positions, is_insertion):
+    # return start and end of lowercase sequences in seq inside the [start, end] intervals
+    return [((aligned_positions[run_start] + aligned_positions[run_end]) / 2, seq[run_start:run_end + 1].upper())
+            for run_start, run_end in clip_runs(is_insertion, starts, ends)]
+
+
+metrics.register_cache('tables', table_cache.stats)
+metrics.register_cache('matrix_tables', metrics.lru_cache_stats(get_matrix_table))
+metrics.register_cache('kmer_hits', bindline.kmer_hits_cache.stats)
+metrics.register_cache('alignments', alignment.alignment_cache.memory.stats)
+metrics.register_cache('alignments_disk', alignment.alignment_cache.disk_stats)
+metrics.register_cache('results', result_cache.memory.stats)
+metrics.register_cache('results_disk', result_cache.disk_stats)
+metrics.register_cache('file_hashes', metrics.lru_cache_stats(hash_file))
+
+
+@bp.before_app_request
+def start_request_metrics():
+    if metrics.enabled:
+        g.metrics_token, g.request_start = metrics.start_request(), time.perf_counter()
+
+
+@bp.after_app_request
+def record_request_metrics(response):
+    # the time until the response is returned, a streamed body is sent later
+    token = g.pop('metrics_token', None)
+    if token is not None:
+        seconds = time.perf_counter() - g.request_start
+        timings = metrics.end_request(token)
+        metrics.observe(metrics.REQUEST_SECONDS, (('endpoint', request.endpoint or 'unknown'),
+                                                  ('status', str(response.status_code))), seconds)
+        if consts.SERVER_TIMING:
+            response.headers['Server-Timing'] = metrics.server_timing({**timings, 'total': seconds})
+    return response
+
+
+@bp.teardown_app_request
+def end_request_metrics(error):
+    # requests which failed before their response
+    token = g.pop('metrics_token', None)
+    if token is not None:
+        metrics.end_request(token)
+
+
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def warmup():
+    # load what the first scoring requests would: the identifiers with their matrices and k-mer indices, and the aligner
+    for file_type in SCORE_MATRIX_PATHS:
+        get_identifier_by_type(file_type)
+    alignment.get_aligner()
+
+
+def create_app(config=None):
+    # nothing heavy is loaded here, the identifiers are loaded on their first use, or here if WARMUP is set
+    app = Flask(__name__)
+    CORS(app)
+    app.config['UPLOAD_FOLDER'] = consts.UPLOAD_DIR
+    app.config['FASTA_FOLDER'] = consts.FASTA_DIR
+    app.config['ESCORE_FOLDER'] = consts.ESCORE_DIR
+    app.config['WARMUP'] = False
+    app.config.update(config or {})
+
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['FASTA_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['ESCORE_FOLDER'], exist_ok=True)
+
+    app.register_blueprint(bp)
+    app.cli.command('warmup', help='Load the identifiers and the aligner, to check they load')(warmup)
+    if app.config['WARMUP']:
+        warmup()
+    return app
+
+
+app = create_app()
 
 
 if __name__ == '__main__':
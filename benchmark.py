@@ -0,0 +1,299 @@
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import random
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+
+import numpy as np
+
+import consts
+import bindline
+import alignment
+import score_matrices
+
+# the column layouts of the 8-mer files mer8_to_dict accepts: the score types after the two k-mer columns,
+# None for the columns which are not read
+MER8_LAYOUTS = {
+    'cols3': ['E'],
+    'cols4_ei': ['E', 'I'],
+    'cols4_ie': ['I', 'E'],
+    'cols5': ['E', 'I', 'Z'],
+    'cols9': ['I', 'E', 'Z', None, None, None, None],
+    'cols20': ['I', 'E', 'Z'] + [None] * 15,
+}
+MER = 8
+MOTIF_LENGTH = 6
+COMPLEMENT = str.maketrans('ACGT', 'TGCA')
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def random_seq(rng, length):
+    return ''.join(rng.choice('ACGT') for _ in range(length))
+
+
+def mer8_rows(rng, mer=MER):
+    # every k-mer with its reverse complement once, and E/Z/I scores which are high for the k-mers of a random motif
+    motif = random_seq(rng, MOTIF_LENGTH)
+    kmers = bindline.index_to_kmers(np.arange(4 ** mer), mer)
+    pairs = [(kmer, reverse_complement(kmer)) for kmer in kmers if kmer <= reverse_complement(kmer)]
+    escores = np.array([rng.uniform(0.35, 0.5) if motif in kmer or motif in rc else rng.uniform(-0.5, 0.35)
+                        for kmer, rc in pairs])
+    zscores = escores * 20 + np.array([rng.gauss(0, 1) for _ in pairs])
+    iscores = np.exp(escores * 8 + 7)
+    return pairs, {'E': escores, 'Z': zscores, 'I': iscores}
+
+
+def mer8_content(rng, layout, header=True, mer=MER):
+    # a synthetic 8-mer file in the layout, as text
+    pairs, scores = mer8_rows(rng, mer)
+    columns = MER8_LAYOUTS[layout]
+    lines = []
+    if header:
+        lines.append('\t'.join(['8-mer', '8-mer'] + [f'{score_type or "Other"}-score' for score_type in columns]))
+    for i, (kmer, rc) in enumerate(pairs):
+        values = [f'{scores[score_type][i]:.5f}' if score_type else f'{rng.random():.4g}' for score_type in columns]
+        lines.append('\t'.join([kmer, rc] + values))
+    return '\n'.join(lines) + '\n'
+
+
+def mutate_seq(rng, seq, edits):
+    # substitutions, and a few short insertions and deletions
+    seq = list(seq)
+    for _ in range(edits):
+        pos = rng.randrange(len(seq))
+        kind = rng.random()
+        if kind < 0.8:
+            seq[pos] = rng.choice([base for base in 'ACGT' if base != seq[pos]])
+        elif kind < 0.9:
+            seq[pos:pos] = random_seq(rng, rng.randint(1, 4))
+        else:
+            del seq[pos:pos + rng.randint(1, 4)]
+    return ''.join(seq)
+
+
+def fasta_sequences(rng, length, variants, density):
+    # a reference and its variants, each with density * length edits
+    ref = random_seq(rng, length)
+    sequences = {'ref': ref}
+    for i in range(variants):
+        sequences[f'variant{i}'] = mutate_seq(rng, ref, max(1, round(density * length)))
+    return sequences
+
+
+def write_data(rng, args):
+    # score files in all the layouts (cycled over the TFs) and a FASTA, under the uploads directory of the cwd
+    os.makedirs(consts.ESCORE_DIR, exist_ok=True)
+    os.makedirs(consts.FASTA_DIR, exist_ok=True)
+    layouts = list(MER8_LAYOUTS)
+    score_files = []
+    for i in range(args.tfs):
+        layout = layouts[i % len(layouts)]
+        score_file = f'tf{i}_{layout}_8mers.txt'
+        with open(os.path.join(consts.ESCORE_DIR, score_file), 'w') as f:
+            f.write(mer8_content(rng, layout, header=i % 2 == 0))
+        score_files.append(score_file)
+
+    sequences = fasta_sequences(rng, args.length, args.variants, args.density)
+    with open(os.path.join(consts.FASTA_DIR, 'bench.fasta'), 'w') as f:
+        f.writelines(f'>{name}\n{seq}\n' for name, seq in sequences.items())
+    return score_files, sequences
+
+
+def build_matrices(score_files):
+    with open(consts.ESCORE_FILE_LIST, 'w') as f:
+        f.writelines(f'{score_file}\n' for score_file in score_files)
+    failures = score_matrices.build_matrices(score_files, workers=1)
+    if failures:
+        raise RuntimeError(f'Building the matrices failed: {failures}')
+
+
+def time_call(fn, repeat):
+    # seconds of each run, after a warmup run
+    fn()
+    runs = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        runs.append(time.perf_counter() - start)
+    return {'min': min(runs), 'median': statistics.median(runs), 'mean': statistics.mean(runs), 'runs': len(runs)}
+
+
+def clear_caches(app):
+    # the analyses are timed cold: no cached results or alignments
+    app.result_cache.memory.clear()
+    alignment.alignment_cache.memory.clear()
+    shutil.rmtree(consts.RESULT_CACHE_DIR, ignore_errors=True)
+    shutil.rmtree(consts.ALIGNMENT_CACHE_DIR, ignore_errors=True)
+
+
+def function_benchmarks(rng, sequences, score_files):
+    # {name: function} of the hot functions.
+    # the app is imported once the matrices are built, its identifiers load them on their first use
+    import app
+
+    benchmarks = {}
+    for layout in MER8_LAYOUTS:
+        content = mer8_content(rng, layout)
+        benchmarks[f'mer8_to_dict[{layout}]'] = lambda content=content: bindline.mer8_to_dict(content)
+        benchmarks[f'mer8_to_arrays[{layout}]'] = lambda content=content: bindline.mer8_to_arrays(content)
+    content = mer8_content(rng, 'cols5')
+    benchmarks['EScoreTable.__init__'] = lambda: bindline.EScoreTable(content)
+
+    table = bindline.EScoreTable(content)
+    ref = sequences['ref']
+    benchmarks['EScoreTable.score'] = lambda: table.score(ref)
+    benchmarks['EScoreTable.score_seqs'] = lambda: table.score_seqs(sequences)
+
+    identifier = app.get_identifier_by_type('escore')
+    benchmarks['TFIdentifier[absolute]'] = lambda: identifier(sequences, absolute_threshold=0.45, rank_threshold=None)
+    benchmarks['TFIdentifier[rank]'] = lambda: identifier(sequences, absolute_threshold=None, rank_threshold=99)
+    matrix = bindline.load_score_matrix(app.get_score_matrix_path('escore'))
+    benchmarks['score_matrix_rows'] = lambda: bindline.score_matrix_rows(matrix, list(range(len(matrix))),
+                                                                         list(sequences.values()))
+    benchmarks['rank_matrix'] = lambda: bindline.rank_matrix(matrix.values)
+
+    variants = [seq for name, seq in sequences.items() if name != 'ref']
+    benchmarks['alignment.align'] = lambda: [alignment.align(ref, seq) for seq in variants]
+    benchmarks['alignment.align_sequences[cached]'] = lambda: [alignment.align_sequences(ref, seq) for seq in variants]
+
+    aligned_seqs, aligned_positions = app.align_to_ref(sequences, 'ref')
+    name = next((name for name in sequences if name != 'ref'), 'ref')
+    table_file = os.path.join(consts.ESCORE_DIR, score_files[0])
+    score_table = app.get_score_table(table_file, 'escore')
+    scores = app.gap_scores(aligned_seqs[name], sequences[name], score_table.score(sequences[name]))
+    highest_values = [score if score is not None and score >= 0.45 else None for score in scores]
+    benchmarks['get_binding_sites'] = lambda: app.get_binding_sites(highest_values, aligned_seqs[name], score_table.mer,
+                                                                    aligned_positions[name])
+    return benchmarks
+
+
+def endpoint_benchmarks(sequences, score_files, mutation_length):
+    # {name: function} of the requests to the endpoints, through the test client
+    import app
+    client = app.app.test_client()
+
+    def upload(cached=False, headers=None, **fields):
+        form = {'file_type': 'escore', 'sequences': json.dumps(sequences), 'ref_name': 'ref',
+                'search_binding_sites': 'false', 'search_significant_mutations': 'false', 'show_diff_only': 'false'}
+        form.update({f'e_score_{i}': score_file for i, score_file in enumerate(score_files)})
+        form.update(fields)
+
+        def request():
+            if not cached:
+                clear_caches(app)
+            response = client.post('/upload', data=form, headers=headers or {})
+            response.get_data()
+            assert response.status_code == 200, response.get_data(as_text=True)
+        return request
+
+    def load_sequences():
+        response = client.post('/sequences', data={'existing_fasta': 'bench.fasta'})
+        assert response.status_code == 200, response.get_data(as_text=True)
+
+    short = {'ref': sequences['ref'][:mutation_length]}
+    return {
+        '/sequences': load_sequences,
+        '/upload': upload(),
+        '/upload[stream]': upload(stream='true'),
+        '/upload[threshold]': upload(escore_threshold_input='0.45'),
+        '/upload[diff]': upload(escore_threshold_input='0.45', show_diff_only='true'),
+        '/upload[packed]': upload(escore_threshold_input='0.45', headers={
+            'Accept': 'application/x-bindline-packed', 'Accept-Encoding': 'gzip'}),
+        '/upload[cached]': upload(cached=True, escore_threshold_input='0.45'),
+        '/upload[binding_sites]': upload(search_binding_sites='true', escore_threshold_input='0.45'),
+        '/upload[binding_sites,rank]': upload(search_binding_sites='true', ranks_threshold_input='99'),
+        '/upload[significant_mutations]': upload(search_significant_mutations='true', escore_threshold_input='0.45',
+                                                 sequences=json.dumps(short)),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    with tempfile.TemporaryDirectory() as work_dir:
+        # all the data and caches are written under the uploads directory of the working directory
+        os.chdir(work_dir)
+        score_files, sequences = write_data(rng, args)
+        build_matrices(score_files)
+
+        benchmarks = {}
+        benchmarks.update(function_benchmarks(rng, sequences, score_files))
+        benchmarks.update(endpoint_benchmarks(sequences, score_files, args.mutation_length))
+
+        results = {}
+        for name, fn in benchmarks.items():
+            if args.filter and args.filter not in name:
+                continue
+            results[name] = time_call(fn, args.repeat)
+            print(f'{name:40s} {results[name]["median"] * 1000:10.2f} ms', file=sys.stderr)
+    return {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'args': vars(args),
+        },
+        'results': results,
+    }
+
+
+def compare(before, after):
+    # the median of each benchmark in both reports, and their ratio (below 1 is faster)
+    out = io.StringIO()
+    out.write(f'{"benchmark":40s} {"before ms":>10s} {"after ms":>10s} {"ratio":>7s}\n')
+    for name, result in after['results'].items():
+        if name in before['results']:
+            old, new = before['results'][name]['median'], result['median']
+            out.write(f'{name:40s} {old * 1000:10.2f} {new * 1000:10.2f} {new / old:7.2f}\n')
+    return out.getvalue()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the hot functions and the endpoints on synthetic data')
+    parser.add_argument('--tfs', type=int, default=12, help='Number of synthetic score files (TFs in the matrices)')
+    parser.add_argument('--length', type=int, default=1000, help='Length of the reference sequence')
+    parser.add_argument('--variants', type=int, default=8, help='Number of variants of the reference')
+    parser.add_argument('--density', type=float, default=0.01, help='Edits per base of each variant')
+    parser.add_argument('--mutation-length', type=int, default=60,
+                        help='Length of the sequence of the significant mutations search')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs of each benchmark')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--filter', help='Run only the benchmarks whose name contains this')
+    parser.add_argument('--output', help='Write the JSON report to this file (default: stdout)')
+    parser.add_argument('--compare', help='A previous JSON report to compare the results with')
+    args = parser.parse_args()
+
+    # the paths are resolved before running in the working directory of the benchmark
+    output = os.path.abspath(args.output) if args.output else None
+    previous = os.path.abspath(args.compare) if args.compare else None
+    report = run(args)
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    if previous:
+        with open(previous) as f:
+            print(compare(json.load(f), report), file=sys.stderr)
@@ -1,17 +1,37 @@
 import functools
+import importlib
 import itertools
+import json
 import os
 import re
+import sys
 import zipfile
+from collections.abc import Mapping
 from io import StringIO
 
-import pandas as pd
-import seqlogo
 import numpy as np
-from matplotlib import pyplot as plt
-from matplotlib.gridspec import GridSpec
+from numpy.lib.stride_tricks import sliding_window_view
 import pickle
 
+import cache
+import consts
+import metrics
+
+
+class LazyModule:
+    # imported on the first use of its attributes, the scoring never needs the plotting stack
+    def __init__(self, name):
+        self._name = name
+
+    def __getattr__(self, attr):
+        return getattr(importlib.import_module(self._name), attr)
+
+
+pd = LazyModule('pandas')
+seqlogo = LazyModule('seqlogo')
+plt = LazyModule('matplotlib.pyplot')
+gridspec = LazyModule('matplotlib.gridspec')
+
 
 EPS = 0.00001
 COLS = 3
@@ -23,11 +43,19 @@ NAME_TO_BBOX = {
 
 COLORS = ('b', 'g', 'r', 'c', 'm', 'y', 'k')
 
+DNA_BASES = 'ACGT'
+
 MIN_INTERESTING_SCORE = {'pwm': 0, '8mer': 0.45}
 MIN_INTERESTING_DIFF = {'pwm': 3, '8mer': 0.05}
 SURROUNDINGS = 15
 MER8_HIGHEST = 0.45
 
+# 2-bit code of each nucleotide, any other character (N, lowercase, gaps) is invalid
+INVALID_BASE = 4
+BASE_CODES = np.full(256, INVALID_BASE, dtype=np.uint8)
+for _code, _base in enumerate('ACGT'):
+    BASE_CODES[ord(_base)] = _code
+
 
 class ExpFile:
     def __init__(self, zip_file, pwm=True, escore=True):
@@ -306,48 +334,111 @@ class PWMTable(ResultTable):
     def to_logo(self):
         return logo_from_ppm(self._prob_table)
 
+    @property
+    def width(self):
+        return self._table.shape[1]
+
     def score(self, seq):
-        scores = np.zeros(len(seq) - self._table.shape[1] + 1)
-        # for each position in the sequence
-        for i in range(len(seq) - self._table.shape[1] + 1):
-            # calculate the score of the motif
-            score = 0
-            for j in range(self._table.shape[1]):
-                score += self._table['ACGT'.index(seq[i + j]), j]
-            scores[i] = score
-        return scores
+        return self.score_stacked([self], seq)[0]
+
+    @staticmethod
+    def score_stacked(tables, seq):
+        # score many PWMs in one tensor operation, narrower PWMs are padded with zero log-odds columns.
+        # the columns are summed in order, so the scores are identical to summing them one by one
+        codes = encode_seq(seq)
+        if (codes == INVALID_BASE).any():
+            raise ValueError(f'Invalid nucleotide in sequence: {seq[np.argmax(codes == INVALID_BASE)]}')
+        widths = [table.width for table in tables]
+        max_width, min_width = max(widths), min(widths)
+        n_windows = max(len(seq) - min_width + 1, 0)
+        stacked = np.zeros((len(tables), 4, max_width))
+        for i, table in enumerate(tables):
+            stacked[i, :, :table.width] = table._table
+        # padded positions beyond the sequence hit only zero columns
+        codes = np.concatenate([codes, np.zeros(max_width - min_width, dtype=codes.dtype)])
+        scores = np.zeros((len(tables), n_windows))
+        for j in range(max_width):
+            scores += stacked[:, codes[j:j + n_windows], j]
+        return [scores[i, :max(len(seq) - width + 1, 0)] for i, width in enumerate(widths)]
 
     def highest_score(self):
         return self._table.max(axis=0).sum()
 
 
+def score_pwm_tables(tables, seqs):
+    # score_seqs of many PWM tables at once, every sequence is scored by all the tables together
+    seqs_scores = {name: PWMTable.score_stacked(tables, seq) for name, seq in seqs.items()} if tables else {}
+    return [{name: (seq, seqs_scores[name][i]) for name, seq in seqs.items()} for i in range(len(tables))]
+
+
 class EScoreTable(ResultTable):
     def __init__(self, table, score_type='E'):
-        self._dict = mer8_to_dict(table, score_type=score_type)
-        self._mer = len(next(iter(self._dict)))
+        arrays = mer8_to_arrays(table)
+        if score_type not in arrays:
+            raise ValueError(f'No {score_type} score in the table')
+        self._init_array(arrays[score_type])
         super().__init__(table)
 
+    def _init_array(self, array):
+        self._array = np.asarray(array, dtype=float)
+        self._mer = int(round(np.log(self._array.shape[0]) / np.log(4)))
+        self._kmer_dict = None
+        # relative threshold -> score cutoff, kept on the table so it is freed with it
+        self._rank_thresholds = {}
+
+    @classmethod
+    def from_array(cls, array):
+        # table of a dense 4^k scores array, like a row of a ScoreMatrix, without the original file
+        table = cls.__new__(cls)
+        table._init_array(array)
+        ResultTable.__init__(table, None)
+        return table
+
+    @property
+    def _dict(self):
+        # k-mer -> score of all the k-mers in the table, built from the dense array on first use
+        if self._kmer_dict is None:
+            columns = np.flatnonzero(~np.isnan(self._array))
+            self._kmer_dict = dict(zip(index_to_kmers(columns, self._mer), self._array[columns].tolist()))
+        return self._kmer_dict
+
     @property
     def mer(self):
         return self._mer
 
+    @property
+    def array(self):
+        # dense 4^k scores, indexed by the 2-bit encoding of the k-mer (NaN for missing k-mers)
+        return self._array
+
     def score(self, seq):
-        scores = np.zeros(len(seq) - self._mer + 1)
-        # for each position in the sequence
-        for i in range(scores.shape[0]):
-            # calculate the score of the motif
-            scores[i] = self._dict.get(seq[i:i + self._mer], None)  # TODO: None?
-        return scores
+        # windows that are missing from the table or contain non-ACGT characters are NaN
+        return self.score_batch([seq])[0]
+
+    @metrics.timed('EScoreTable.score_batch')
+    def score_batch(self, seqs):
+        # score all sequences with a single gather over their concatenated windows
+        if not seqs:
+            return []
+        indices, valid = map(list, zip(*(kmer_indices(seq, self._mer) for seq in seqs)))
+        all_indices, all_valid = np.concatenate(indices), np.concatenate(valid)
+        all_scores = np.full(all_indices.shape[0], np.nan)
+        all_scores[all_valid] = self._array[all_indices[all_valid]]
+        return np.split(all_scores, np.cumsum([len(i) for i in indices])[:-1])
+
+    def score_seqs(self, seqs):
+        scores = self.score_batch(list(seqs.values()))
+        return {name: (seq, seq_scores) for (name, seq), seq_scores in zip(seqs.items(), scores)}
 
     def max_score(self):
-        return max(self._dict.values())
+        return np.nanmax(self._array)
 
-    @functools.lru_cache(maxsize=1000)
     def rank_threshold(self, relative_threshold):
         # get the threshold of the relative threshold
-        sorted_scores = sorted(self._dict.values())
-        return sorted_scores[int(len(sorted_scores) * relative_threshold / 100)]
-
+        if relative_threshold not in self._rank_thresholds:
+            sorted_scores = np.sort(self._array[~np.isnan(self._array)])
+            self._rank_thresholds[relative_threshold] = sorted_scores[int(len(sorted_scores) * relative_threshold / 100)]
+        return self._rank_thresholds[relative_threshold]
 
 
 class ZScoreTable(EScoreTable):
@@ -654,7 +745,7 @@ def is_interesting(seq_scores, typ, highest):
     return False
 
 def create_gs(rows, cols=COLS):
-    gs = GridSpec(rows, cols, width_ratios=[1] * cols, height_ratios=[rows+1]+[1]*(rows-1))
+    gs = gridspec.GridSpec(rows, cols, width_ratios=[1] * cols, height_ratios=[rows+1]+[1]*(rows-1))
     for i in range(cols, cols + (rows - 1) * cols):
         ax = plt.subplot(gs[i // cols, i % cols])
         # remove x and y axes
@@ -678,6 +769,109 @@ def logo_from_ppm(ppm):
     os.remove('tmp.png')
     return logo
 
+MER8_SCORE_COLUMNS = {
+    3: {'E': 2},
+    5: {'E': 2, 'I': 3, 'Z': 4},
+    9: {'I': 2, 'E': 3, 'Z': 4},
+    20: {'I': 2, 'E': 3, 'Z': 4}
+}
+MER8_SIDECAR_SUFFIX = '.scores.npy'
+# the significant digits of the scores, which float32 keeps exactly (see load_mer8_arrays)
+MER8_SIDECAR_DIGITS = 6
+
+
+def is_mer8_sidecar(path):
+    # the sidecar of a mer8 file, or a sidecar being written
+    return path.endswith(MER8_SIDECAR_SUFFIX) or MER8_SIDECAR_SUFFIX + '.' in path and path.endswith('.tmp')
+
+
+def mer8_score_columns(cols_num, first_score):
+    # the score column of each score type, by the number of columns (and the first score for 4 columns)
+    if cols_num in MER8_SCORE_COLUMNS:
+        return MER8_SCORE_COLUMNS[cols_num]
+    if cols_num == 4:
+        return {'E': 2, 'I': 3} if float(first_score) <= 0.5 else {'I': 2, 'E': 3}
+    raise ValueError('mer8 file has wrong number of columns')
+
+
+@metrics.timed('mer8_to_arrays')
+def mer8_to_arrays(mer8_content):
+    # parse all the score columns of a mer8 file in one pass (see mer8_to_dict for the formats).
+    # returns {score type: dense 4^mer array}, NaN for k-mers missing from the file
+    if type(mer8_content) == bytes:
+        mer8_content = mer8_content.decode('utf8')
+    mer8_content = mer8_content.strip(' \r\n')
+    # skip the header if exists, and determine the file format by the first row
+    first_lines = [line.strip(' \r\n').split('\t') for line in mer8_content.split('\n', 2)[:2]]
+    has_header = bool(set(first_lines[0][0]) - set('ACGT'))
+    first_row = first_lines[int(has_header)]
+    score_columns = mer8_score_columns(len(first_row), first_row[2] if len(first_row) > 2 else None)
+    # read only the k-mer and score columns, the scores as numbers (missing scores are -0.5, like in mer8_to_dict)
+    rows = pd.read_csv(StringIO(mer8_content), sep='\t', header=None, skiprows=int(has_header),
+                       usecols=[0, 1, *score_columns.values()],
+                       dtype={0: str, 1: str, **{col: np.float64 for col in score_columns.values()}},
+                       na_values=['', 'NA'], keep_default_na=False)
+
+    fwd, rev = rows[0].tolist(), rows[1].tolist()
+    mer = len(fwd[0])
+    fwd_indices, fwd_valid = kmers_to_indices(fwd, mer)
+    rev_indices, rev_valid = kmers_to_indices(rev, mer)
+
+    arrays = {}
+    for score_type, col in score_columns.items():
+        values = rows[col].fillna(-0.5).to_numpy()
+        array = np.full(4 ** mer, np.nan)
+        # the reverse complement is set last, like in mer8_to_dict
+        array[fwd_indices[fwd_valid]] = values[fwd_valid]
+        array[rev_indices[rev_valid]] = values[rev_valid]
+        arrays[score_type] = array
+    return arrays
+
+
+def round_significant(values, digits=MER8_SIDECAR_DIGITS):
+    # the values rounded to their significant digits, as the nearest float64 of the rounded decimal
+    values = np.asarray(values, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        exponents = digits - 1 - np.floor(np.log10(np.abs(values)))
+    scales = 10.0 ** np.abs(np.where(np.isfinite(exponents), exponents, 0))
+    # dividing by an exact power of ten is correctly rounded, multiplying by an inexact negative power is not
+    return np.where(exponents >= 0, np.round(values * scales) / scales, np.round(values / scales) * scales)
+
+
+def mer8_sidecar_dtype(array):
+    # float32 if the scores are restored exactly from it by round_significant, float64 otherwise
+    return np.float32 if np.array_equal(round_significant(array.astype(np.float32)), array, equal_nan=True) else np.float64
+
+
+def load_mer8_arrays(path):
+    # the score arrays of a mer8 file, from a binary sidecar next to the file.
+    # the sidecar gets the mtime of the file, and is (re)written when it is missing or the mtimes differ.
+    # it is a single record with a field of each score type in the file, float32 where it keeps the scores
+    sidecar_path = path + MER8_SIDECAR_SUFFIX
+    mtime_ns = os.stat(path).st_mtime_ns
+    if os.path.exists(sidecar_path) and os.stat(sidecar_path).st_mtime_ns == mtime_ns:
+        record = np.load(sidecar_path, mmap_mode='r')
+        # the sidecars of older versions have no fields, they are written again
+        if record.dtype.names:
+            return {score_type: round_significant(record[score_type][0]) if record.dtype[score_type].base == np.float32
+                    else record[score_type][0] for score_type in record.dtype.names}
+
+    with open(path, 'r') as file:
+        arrays = mer8_to_arrays(file.read())
+    record = np.empty(1, dtype=[(score_type, mer8_sidecar_dtype(array), array.shape) for score_type, array in arrays.items()])
+    for score_type, array in arrays.items():
+        record[score_type][0] = array
+    tmp_path = f'{sidecar_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as file:
+            np.save(file, record)
+        os.utime(tmp_path, ns=(mtime_ns, mtime_ns))
+        os.replace(tmp_path, sidecar_path)
+    except OSError:
+        pass
+    return arrays
+
+
 def mer8_to_dict(mer8_content, score_type='E'):
     # mer8 file is tsv with the columns 8-mer,8-mer-rev,E-score,Median,Z-score
     # read the file into 2 dicts, one for the forward and one for the reverse
@@ -694,20 +888,10 @@ def mer8_to_dict(mer8_content, score_type='E'):
         mer8_content = mer8_content[1:]
     # determine file format by number of columns
     cols_num = len(mer8_content[0])
-    score_column = {
-        3: {'E': 2},
-        5: {'E': 2, 'I': 3, 'Z': 4},
-        9: {'I': 2, 'E': 3, 'Z': 4},
-        20: {'I': 2, 'E': 3, 'Z': 4}
-     }
-    if cols_num not in score_column:
-        if cols_num == 4:
-            score_column[cols_num] = {'E': 2, 'I': 3} if float(mer8_content[0][2]) <= 0.5 else {'I': 2, 'E': 3}
-        else:
-            raise ValueError('mer8 file has wrong number of columns')
-    if score_type not in score_column[cols_num]:
+    score_column = mer8_score_columns(cols_num, mer8_content[0][2] if cols_num > 2 else None)
+    if score_type not in score_column:
         raise ValueError(f'No {score_type} score in the table')
-    score_idx = score_column[cols_num][score_type]
+    score_idx = score_column[score_type]
     # if cols_num == 5:
     #     mer8_content = mer8_content[1:]
     mer8_dict = {i[0]: -0.5 if i[score_idx] in ('', 'NA') else float(i[score_idx]) for i in mer8_content}
@@ -715,6 +899,44 @@ def mer8_to_dict(mer8_content, score_type='E'):
     return mer8_dict
 
 
+def encode_seq(seq):
+    # 2-bit encoding of a sequence, INVALID_BASE for every non-ACGT character
+    return BASE_CODES[np.frombuffer(seq.encode('latin1', errors='replace'), dtype=np.uint8)]
+
+
+def kmer_indices(seq, mer):
+    # rolling 2-bit hash of every window in seq, and whether the window contains only ACGT
+    n_windows = max(len(seq) - mer + 1, 0)
+    if n_windows == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=bool)
+    codes = encode_seq(seq)
+    invalid = codes == INVALID_BASE
+    windows = sliding_window_view(np.where(invalid, 0, codes).astype(np.int64), mer)
+    indices = windows @ (4 ** np.arange(mer - 1, -1, -1, dtype=np.int64))
+    invalid_count = np.concatenate([[0], np.cumsum(invalid)])
+    valid = invalid_count[mer:] == invalid_count[:n_windows]
+    return indices, valid
+
+
+def kmers_to_indices(kmers, mer):
+    # 2-bit hash of each k-mer, and whether it is a valid k-mer (only ACGT, of length mer)
+    if all(len(kmer) == mer for kmer in kmers):
+        codes = encode_seq(''.join(kmers)).reshape(-1, mer)
+        indices = codes.astype(np.int64) @ (4 ** np.arange(mer - 1, -1, -1, dtype=np.int64))
+        return indices, (codes != INVALID_BASE).all(axis=1)
+    indices, valid = np.zeros(len(kmers), dtype=np.int64), np.zeros(len(kmers), dtype=bool)
+    for i, kmer in enumerate(kmers):
+        if len(kmer) == mer:
+            indices[i:i + 1], valid[i:i + 1] = kmers_to_indices([kmer], mer)
+    return indices, valid
+
+
+def index_to_kmers(indices, mer):
+    # the k-mers of 2-bit hashes
+    codes = (np.asarray(indices)[:, None] >> (2 * np.arange(mer - 1, -1, -1))) & 3
+    return [''.join(kmer) for kmer in np.array(list('ACGT'))[codes]]
+
+
 def align_scores(scores_wt, scores_del):
     # check where DEL_SITE Nones should be inserted to scores_del in order to get the least sum of squares
     del_size = len(scores_wt) - len(scores_del)
@@ -730,6 +952,133 @@ def align_scores(scores_wt, scores_del):
     return min_i
 
 
+# change of the sequence length by each mutation type: substitution, insertion and deletion
+MUTATION_LENGTH_CHANGE = {'m': 0, 'i': 1, 'd': -1}
+
+
+def mutate(seq, kind, pos, base=None):
+    # substitute the base in pos, insert base before pos, or delete the base in pos
+    if kind == 'm':
+        return seq[:pos] + base + seq[pos + 1:]
+    if kind == 'i':
+        return seq[:pos] + base + seq[pos:]
+    if kind == 'd':
+        return seq[:pos] + seq[pos + 1:]
+    raise ValueError("Invalid mutation type.")
+
+
+def mutant_window_spans(ref_len, mer, kind, pos):
+    # the windows [start, end) of the mutant overlap the mutation and have to be rescored.
+    # the windows before start are the reference windows, and the windows from end on are
+    # the reference windows from ref_start on
+    length_change = MUTATION_LENGTH_CHANGE[kind]
+    n_windows = max(ref_len + length_change - mer + 1, 0)
+    # a deletion changes only the windows which span the junction of its two sides
+    last_changed = pos - 1 if kind == 'd' else pos
+    start = min(max(pos - mer + 1, 0), n_windows)
+    end = min(max(last_changed + 1, start), n_windows)
+    return start, end, end - length_change
+
+
+class MutationScan:
+    # delta scoring of single mutants of a reference sequence. a mutation changes at most mer windows,
+    # so only these windows are rescored and the others are taken from the reference scores
+    def __init__(self, ref_seq, mutations, mer):
+        # mutations is {mutant name: (kind, pos, base)}
+        self._ref_seq, self._mer = ref_seq, mer
+        self._spans = {}
+        indices, valid = [], []
+        offset = 0
+        for name, (kind, pos, base) in mutations.items():
+            start, end, ref_start = mutant_window_spans(len(ref_seq), mer, kind, pos)
+            # the part of the mutant covered by the rescored windows, mutated from the reference
+            ref_part_len = max(end - start + mer - 1, 0) - MUTATION_LENGTH_CHANGE[kind] if end > start else 0
+            local_seq = mutate(ref_seq[start:start + ref_part_len], kind, pos - start, base) if end > start else ''
+            local_indices, local_valid = kmer_indices(local_seq, mer)
+            indices.append(local_indices)
+            valid.append(local_valid)
+            self._spans[name] = (start, ref_start, offset, offset + end - start)
+            offset += end - start
+        self._indices = np.concatenate(indices) if indices else np.zeros(0, dtype=np.int64)
+        self._valid = np.concatenate(valid) if valid else np.zeros(0, dtype=bool)
+        self._substitution_windows, self._substituted = self.__substitution_windows(mutations, offset)
+
+    def __substitution_windows(self, mutations, padding_index):
+        # (L x 4 x mer) indices of the rescored windows of each substitution, padding_index where there are less
+        # windows or no substitution (the reference base), and (L x 4) whether there is a substitution
+        windows = np.full((len(self._ref_seq), len(DNA_BASES), self._mer), padding_index, dtype=np.int64)
+        substituted = np.zeros((len(self._ref_seq), len(DNA_BASES)), dtype=bool)
+        for name, (kind, pos, base) in mutations.items():
+            if kind != 'm' or base not in DNA_BASES:
+                continue
+            _, _, local_start, local_end = self._spans[name]
+            windows[pos, DNA_BASES.index(base), :local_end - local_start] = np.arange(local_start, local_end)
+            substituted[pos, DNA_BASES.index(base)] = True
+        return windows, substituted
+
+    def __len__(self):
+        return len(self._spans)
+
+    def local_scores(self, table):
+        # the scores of all the rescored windows of all the mutants, with a single gather
+        local = np.full(self._indices.shape[0], np.nan)
+        local[self._valid] = table.array[self._indices[self._valid]]
+        return local
+
+    def mutant_scores(self, name, ref_scores, local_scores):
+        start, ref_start, local_start, local_end = self._spans[name]
+        return np.concatenate([ref_scores[:start], local_scores[local_start:local_end], ref_scores[ref_start:]])
+
+    @metrics.timed('MutationScan.scores')
+    def scores(self, table, seqs, ref_name):
+        # score_seqs of the reference and all the mutants in seqs, computed lazily per mutant
+        return MutantScores(self, seqs, ref_name, table.score(self._ref_seq), self.local_scores(table))
+
+    def substitution_effects(self, ref_scores, local_scores):
+        # (... x L x 4) change of the max score of the windows overlapping each position by each substitution.
+        # leading dimensions of the scores (like score files) are kept, not substituted bases are NaN
+        local_scores = np.concatenate([local_scores, np.full(local_scores.shape[:-1] + (1,), -np.inf)], axis=-1)
+        effects = local_scores[..., self._substitution_windows].max(axis=-1) - sliding_max(ref_scores, self._mer)[..., None]
+        effects[..., ~self._substituted] = np.nan
+        return effects
+
+
+class MutantScores(Mapping):
+    # {name: (sequence, scores)} of a MutationScan, every mutant vector is built on access
+    def __init__(self, scan, seqs, ref_name, ref_scores, local_scores):
+        self._scan, self._seqs, self._ref_name = scan, seqs, ref_name
+        self._ref_scores, self._local_scores = ref_scores, local_scores
+
+    def __getitem__(self, name):
+        if name == self._ref_name:
+            return self._seqs[name], self._ref_scores
+        return self._seqs[name], self._scan.mutant_scores(name, self._ref_scores, self._local_scores)
+
+    def __iter__(self):
+        return iter(self._seqs)
+
+    def __len__(self):
+        return len(self._seqs)
+
+    def substitution_effects(self):
+        return self._scan.substitution_effects(self._ref_scores, self._local_scores)
+
+    @staticmethod
+    def stack_substitution_effects(mutant_scores):
+        # (files x L x 4) substitution effects of the scores of many tables on the same scan, at once
+        scan = mutant_scores[0]._scan
+        assert all(i._scan is scan for i in mutant_scores), "All the scores should be of the same scan"
+        return scan.substitution_effects(np.stack([i._ref_scores for i in mutant_scores]),
+                                         np.stack([i._local_scores for i in mutant_scores]))
+
+
+def sliding_max(scores, mer):
+    # max of every mer windows overlapping each position, along the last axis
+    pad = [(0, 0)] * (np.ndim(scores) - 1) + [(mer - 1, mer - 1)]
+    scores = np.pad(scores, pad, mode="constant", constant_values=-np.inf)
+    return np.max(sliding_window_view(scores, window_shape=mer, axis=-1), axis=-1)
+
+
 def get_seqs_from_fasta(fasta_file):
     # return all sequences in fasta_file as a dict
     seqs = {}
@@ -761,43 +1110,403 @@ class TFIdentifier:
     def __call__(self, seqs):
         return {name: (seq, self.identify(seq)) for name, seq in seqs.items()}
 
-import time
+class ScoreMatrix:
+    # rows x 4^mer matrix of k-mer scores, columns ordered by the 2-bit encoding of the k-mer,
+    # the rows are the score files the scores were taken from
+    def __init__(self, values, index):
+        assert values.shape[0] == len(index), "Number of rows and index length differ"
+        self.values = values
+        self.index = list(index)
+        self.mer = int(round(np.log(values.shape[1]) / np.log(4)))
+        self._row_by_name = None
+        self._filled_rows = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def row(self, name):
+        if self._row_by_name is None:
+            self._row_by_name = {name: i for i, name in enumerate(self.index)}
+        return self._row_by_name[name]
+
+    @classmethod
+    def from_frame(cls, df):
+        # reorder the k-mer columns by their 2-bit encoding
+        mer = len(df.columns[0])
+        indices, valid = kmer_indices(''.join(df.columns), mer)
+        columns = indices[::mer][valid[::mer]]
+        values = np.full((df.shape[0], 4 ** mer), np.nan)
+        values[:, columns] = df.to_numpy(dtype=float)[:, valid[::mer]]
+        return cls(values, df.index)
+
+    def to_frame(self):
+        columns = [''.join(i) for i in itertools.product('ACGT', repeat=self.mer)]
+        return pd.DataFrame(np.asarray(self.values), index=self.index, columns=columns)
+
+    @staticmethod
+    def rows_path(path):
+        return os.path.splitext(path)[0] + '.rows.txt'
+
+    def save(self, path):
+        # write to temporary files and replace, so processes which mapped the old files keep a valid copy
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + '.tmp', 'wb') as file:
+            np.save(file, np.ascontiguousarray(self.values))
+        with open(self.rows_path(path) + '.tmp', 'w') as file:
+            file.write(''.join(f'{name}\n' for name in self.index))
+        os.replace(path + '.tmp', path)
+        os.replace(self.rows_path(path) + '.tmp', self.rows_path(path))
+
+    @classmethod
+    def allocate(cls, path, index, mer, fill=np.nan, dtype=float):
+        # a new matrix mapped to a temporary file, to fill in place (also by other processes) and publish by commit
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        values = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=dtype, shape=(len(index), 4 ** mer))
+        values[:] = fill
+        return cls(values, index)
+
+    @staticmethod
+    def open_allocated(path):
+        # the values of a matrix allocated for path, mapped for writing
+        return np.load(path + '.tmp', mmap_mode='r+')
+
+    def commit(self, path):
+        # publish an allocated matrix, processes which mapped the old file keep a valid copy
+        self.values.flush()
+        with open(self.rows_path(path) + '.tmp', 'w') as file:
+            file.write(''.join(f'{name}\n' for name in self.index))
+        os.replace(path + '.tmp', path)
+        os.replace(self.rows_path(path) + '.tmp', self.rows_path(path))
+
+    @classmethod
+    def load(cls, path):
+        # pickled DataFrames of older versions are still supported, but are not shared between processes
+        if path.endswith('.pkl'):
+            with open(path, 'rb') as file:
+                score_matrix = cls.from_frame(pickle.load(file))
+        else:
+            with open(cls.rows_path(path), 'r') as file:
+                index = file.read().splitlines()
+            score_matrix = cls(np.load(path, mmap_mode='r'), index)
+        score_matrix.mtime = os.path.getmtime(path)
+        return score_matrix
+
+    mtime = None
+
+    def take(self, rows, columns):
+        # (rows x columns) block of the values
+        return np.asarray(self.values[np.ix_(rows, columns)])
+
+    def row_values(self, row):
+        return self.values[row]
+
+    def row_mtime(self, row):
+        # when the row was written
+        return self.mtime
+
+    def row_filled(self, row):
+        # whether the row has scores, the rows of the files which failed to build are left empty (NaN).
+        # checked once for each row
+        if row not in self._filled_rows:
+            self._filled_rows[row] = not np.isnan(self.row_values(row)).all()
+        return self._filled_rows[row]
+
+
+class SegmentedScoreMatrix(ScoreMatrix):
+    # a base matrix followed by the rows of its appended segments, every segment is mapped separately
+    def __init__(self, segments):
+        self.segments = segments
+        self.index = [name for segment in segments for name in segment.index]
+        self.mer = segments[0].mer
+        self.offsets = np.cumsum([0] + [len(segment) for segment in segments])
+        self._row_by_name = None
+        self._filled_rows = {}
+
+    @property
+    def values(self):
+        # all the rows concatenated in memory, the lookups by rows do not need it
+        return np.concatenate([np.asarray(segment.values) for segment in self.segments])
+
+    def __segment(self, row):
+        i = int(np.searchsorted(self.offsets, row, side='right')) - 1
+        return self.segments[i], row - self.offsets[i]
+
+    def take(self, rows, columns):
+        rows = np.asarray(rows, dtype=np.int64)
+        block = np.empty((rows.shape[0], len(columns)))
+        for segment, start, end in zip(self.segments, self.offsets[:-1], self.offsets[1:]):
+            in_segment = (rows >= start) & (rows < end)
+            if in_segment.any():
+                block[in_segment] = segment.take(rows[in_segment] - start, columns)
+        return block
+
+    def row_values(self, row):
+        segment, segment_row = self.__segment(row)
+        return segment.row_values(segment_row)
+
+    def row_mtime(self, row):
+        segment, segment_row = self.__segment(row)
+        return segment.row_mtime(segment_row)
+
+    def row_filled(self, row):
+        segment, segment_row = self.__segment(row)
+        return segment.row_filled(segment_row)
+
+
+# segments appended to a matrix are listed, in order, in a manifest in the matrix directory,
+# and kept in a directory per segment with the same file names as the base matrices
+MATRIX_MANIFEST = 'manifest.json'
+MATRIX_SEGMENTS_DIR = 'segments'
+
+
+def read_matrix_manifest(matrix_dir):
+    manifest_path = os.path.join(matrix_dir, MATRIX_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return {'segments': []}
+    with open(manifest_path, 'r') as file:
+        return json.load(file)
+
+
+def write_matrix_manifest(matrix_dir, manifest):
+    manifest_path = os.path.join(matrix_dir, MATRIX_MANIFEST)
+    with open(manifest_path + '.tmp', 'w') as file:
+        json.dump(manifest, file, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def matrix_segment_path(matrix_path, segment):
+    return os.path.join(os.path.dirname(matrix_path), MATRIX_SEGMENTS_DIR, segment, os.path.basename(matrix_path))
+
+
+def matrix_segment_paths(matrix_path):
+    # the base matrix path followed by the paths of all its segments in the manifest
+    if matrix_path.endswith('.pkl'):
+        return [matrix_path]
+    segments = read_matrix_manifest(os.path.dirname(matrix_path))['segments']
+    return [matrix_path] + [matrix_segment_path(matrix_path, segment) for segment in segments]
+
+
+def matrix_fingerprint(matrix_path):
+    # (path, mtime, size) of the matrix and of its segments, changes when the matrix is rebuilt or extended
+    return [(path, os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in matrix_segment_paths(matrix_path)]
+
+
+RANK_DTYPE = np.uint16
+
+
+def rank_matrix(values):
+    # rank of every k-mer in each row of the matrix at once, 0 is the lowest.
+    # NaN scores are not ranked, they get 0 like the lowest score and never pass a rank threshold
+    values = np.asarray(values, dtype=float)
+    # NaNs are sorted last
+    order = np.argsort(values, axis=1, kind='stable')
+    ranks = np.empty(values.shape, dtype=RANK_DTYPE)
+    np.put_along_axis(ranks, order, np.broadcast_to(np.arange(values.shape[1], dtype=RANK_DTYPE), values.shape), axis=1)
+    ranks[np.isnan(values)] = 0
+    return ranks
+
+
+@metrics.timed('score_matrix_rows')
+def score_matrix_rows(matrix, rows, seqs):
+    # score all the sequences against many rows of a matrix with a single gather,
+    # every sequence is encoded once. returns a (rows x windows) block per sequence
+    if not seqs:
+        return []
+    indices, valid = map(list, zip(*(kmer_indices(seq, matrix.mer) for seq in seqs)))
+    all_indices, all_valid = np.concatenate(indices), np.concatenate(valid)
+    all_scores = np.full((len(rows), all_indices.shape[0]), np.nan)
+    if len(rows) and all_valid.any():
+        all_scores[:, all_valid] = matrix.take(rows, all_indices[all_valid])
+    return np.split(all_scores, np.cumsum([len(i) for i in indices])[:-1], axis=1)
+
+
+@functools.lru_cache(maxsize=None)
+def load_score_matrix(path):
+    # memory map every matrix (and its segments) once per process, all the identifiers (and workers) share its pages.
+    # segments appended later are seen after a restart
+    paths = matrix_segment_paths(path)
+    if len(paths) == 1:
+        return ScoreMatrix.load(path)
+    return SegmentedScoreMatrix([ScoreMatrix.load(segment_path) for segment_path in paths])
+
+
+class KmerIndex:
+    # inverted index of a score matrix: for every k-mer, the matrix rows sorted by descending score.
+    # stored k-mer major, so the posting list of a k-mer is contiguous on disk, NaN scores are last
+    def __init__(self, order, scores):
+        self.order = order
+        self.scores = scores
+
+    @classmethod
+    def build(cls, matrix):
+        values = np.asarray(matrix.values).T
+        order = np.argsort(-cls.__signed(values), axis=1, kind='stable').astype(np.int32)
+        return cls(order, np.take_along_axis(values, order, axis=1))
+
+    @staticmethod
+    def __signed(values):
+        # unsigned ranks can not be negated
+        return values.astype(np.int64) if values.dtype.kind == 'u' else values
+
+    @staticmethod
+    def paths(matrix_path):
+        base = os.path.splitext(matrix_path)[0]
+        return base + '.index.order.npy', base + '.index.scores.npy'
+
+    def save(self, matrix_path):
+        for path, values in zip(self.paths(matrix_path), (self.order, self.scores)):
+            with open(f'{path}.{os.getpid()}.tmp', 'wb') as file:
+                np.save(file, values)
+            os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+    @classmethod
+    def is_saved(cls, matrix_path):
+        # the index is valid only if it was written after the matrix
+        return all(os.path.exists(path) and os.path.getmtime(path) >= os.path.getmtime(matrix_path)
+                   for path in cls.paths(matrix_path))
+
+    @classmethod
+    def load(cls, matrix_path):
+        return cls(*(np.load(path, mmap_mode='r') for path in cls.paths(matrix_path)))
+
+    def count_above(self, column, threshold):
+        # number of rows with score >= threshold in the k-mer column, by binary search
+        return int(np.searchsorted(-self.__signed(self.scores[column]), -threshold, side='right'))
+
+    def rows_above(self, column, threshold):
+        return self.order[column, :self.count_above(column, threshold)]
+
+    def max_score(self):
+        # the highest score of each k-mer is the first in its posting list, NaN if the index has no rows
+        if self.scores.shape[1] == 0:
+            return np.nan
+        return np.nanmax(self.scores[:, 0])
+
+
+class SegmentedKmerIndex:
+    # the indices of the segments of a SegmentedScoreMatrix, queried together
+    def __init__(self, indices, offsets):
+        self.indices = indices
+        self.offsets = offsets
+
+    def rows_above(self, column, threshold):
+        return np.concatenate([index.rows_above(column, threshold) + offset
+                               for index, offset in zip(self.indices, self.offsets)])
+
+    def max_score(self):
+        return np.nanmax([index.max_score() for index in self.indices])
+
+
+def load_segment_kmer_index(matrix_path):
+    # the index is written next to the matrix by the scripts which write the matrices, the server only maps it.
+    # the pickled matrices of older builds are loaded whole by every process anyway, their index is built in memory
+    if matrix_path.endswith('.pkl'):
+        return KmerIndex.build(ScoreMatrix.load(matrix_path))
+    if not KmerIndex.is_saved(matrix_path):
+        raise FileNotFoundError(f'The k-mer index of {matrix_path} is missing or older than the matrix, '
+                                f'run convert_matrices.py or score_matrices.py to write it')
+    return KmerIndex.load(matrix_path)
+
+
+@functools.lru_cache(maxsize=None)
+def load_kmer_index(matrix_path):
+    paths = matrix_segment_paths(matrix_path)
+    if len(paths) == 1:
+        return load_segment_kmer_index(matrix_path)
+    return SegmentedKmerIndex([load_segment_kmer_index(path) for path in paths],
+                              load_score_matrix(matrix_path).offsets[:-1])
+
+
+# the rows of the k-mers passing each pair of thresholds, shared by all the presets and bounded by their bytes
+kmer_hits_cache = cache.BoundedCache(consts.KMER_HITS_CACHE_BYTES, sizeof=sys.getsizeof)
+kmer_hits_keys = itertools.count()
+
+
+class KmerHits:
+    # matrix rows passing a fixed pair of thresholds, computed per k-mer on first use and kept in kmer_hits_cache.
+    # safe to share between threads, a race only computes the same k-mer twice
+    def __init__(self, names, kmer_index, absolute_threshold, rank_kmer_index, rank_threshold):
+        # a number instead of the thresholds, the keys of every k-mer are hashed faster.
+        # the k-mers of a preset evicted from get_kmer_hits age out of the cache
+        self._key = next(kmer_hits_keys)
+        # the TF name of each row
+        self.names = names
+        self._kmer_index, self._absolute_threshold = kmer_index, absolute_threshold
+        self._rank_kmer_index, self._rank_threshold = rank_kmer_index, rank_threshold
+
+    def __rows(self, column):
+        # rows passing all the given thresholds, in the matrix order
+        rows = None
+        if self._absolute_threshold:
+            rows = self._kmer_index.rows_above(column, self._absolute_threshold)
+        if self._rank_threshold:
+            rank_rows = self._rank_kmer_index.rows_above(column, self._rank_threshold)
+            rows = rank_rows if rows is None else np.intersect1d(rows, rank_rows, assume_unique=True)
+        return np.sort(rows).astype(np.int32, copy=False)
+
+    def names_of(self, columns):
+        # {column: TF names} of the k-mer columns, the rows are named only for the requested k-mers
+        cached = kmer_hits_cache.get_many([(self._key, column) for column in columns])
+        names = {}
+        for column in columns:
+            rows = cached.get((self._key, column))
+            if rows is None:
+                rows = kmer_hits_cache.put((self._key, column), self.__rows(column))
+            names[column] = [self.names[row] for row in rows.tolist()]
+        return names
+
+
+@functools.lru_cache(maxsize=32)
+def get_kmer_hits(absolute_hypo_file, absolute_threshold, rank_hypo_file, rank_threshold):
+    # shared between identifiers and requests, so repeated threshold presets reuse the k-mers seen before.
+    # unused thresholds are passed with no file, so the identifiers share their rank-only entries
+    kmer_index = load_kmer_index(absolute_hypo_file) if absolute_threshold else None
+    rank_kmer_index = load_kmer_index(rank_hypo_file) if rank_threshold else None
+    names = load_score_matrix(absolute_hypo_file or rank_hypo_file).index
+    return KmerHits(names, kmer_index, absolute_threshold, rank_kmer_index, rank_threshold)
+
+
 class TFIdentifier:
+    # re-entrant, all the per-call state is local or in the shared thresholds cache
     def __init__(self, absolute_hypo_file=None, rank_hypo_file=None, kmer=8):
         assert absolute_hypo_file or rank_hypo_file, "At least one of the files should be provided"
+        self._absolute_hypo_file, self._rank_hypo_file = absolute_hypo_file, rank_hypo_file
         self._mat, self._rank_mat = None, None
+        # the version of the matrices the identifier was loaded with
+        self.fingerprint = [matrix_fingerprint(path) for path in (absolute_hypo_file, rank_hypo_file) if path]
 
         if absolute_hypo_file:
-            with open(absolute_hypo_file, 'rb') as file:
-                self._mat = pickle.load(file)
+            self._mat = load_score_matrix(absolute_hypo_file)
+            load_kmer_index(absolute_hypo_file)
         if rank_hypo_file:
-            with open(rank_hypo_file, 'rb') as file:
-                self._rank_mat = pickle.load(file)
-        # length of the column names is the kmer
-        self._mer = kmer or (len(next(iter(self._mat))) if self._mat else len(next(iter(self._rank_mat))))
+            self._rank_mat = load_score_matrix(rank_hypo_file)
+            # a Python number, integer thresholds would overflow the rank dtype
+            self._rank_max = float(load_kmer_index(rank_hypo_file).max_score())
+        mat = self._mat if self._mat is not None else self._rank_mat
+        self._mer = kmer or mat.mer
 
-    def __identify(self, seq):
-        TFs = []
-        # for each position in the sequence
-        for i in range(len(seq) - self._mer + 1):
-            # calculate the score of the motif
-            # take the TF names which have a value in seq[i:i + self._mer] column by pandas
-            TFs.append(self._threshold_mat[seq[i:i + self._mer]].dropna().index.tolist())
-        return TFs
+    def rank_cutoff(self, rank_threshold):
+        # the lowest integer rank passing the rank threshold (in percents of the highest rank)
+        return int(np.ceil(rank_threshold * self._rank_max / 100))
+
+    def kmer_hits(self, absolute_threshold=None, rank_threshold=None):
+        rank_cutoff = self.rank_cutoff(rank_threshold) if rank_threshold else None
+        return get_kmer_hits(self._absolute_hypo_file if absolute_threshold else None, absolute_threshold or None,
+                             self._rank_hypo_file if rank_cutoff else None, rank_cutoff or None)
+
+    @staticmethod
+    def __identify(indices, valid, names):
+        # for each position in the sequence, take the TF names which pass the thresholds for its k-mer
+        return [list(names[column]) if is_valid else [] for column, is_valid in zip(indices.tolist(), valid.tolist())]
 
+    @metrics.timed('TFIdentifier')
     def __call__(self, seqs, absolute_threshold=None, rank_threshold=None):
         assert absolute_threshold or rank_threshold, "At least one of the thresholds should be provided"
         assert absolute_threshold is None or self._mat is not None, "Absolute matrix is not provided"
         assert rank_threshold is None or self._rank_mat is not None, "Rank matrix is not provided"
 
-        if rank_threshold:
-            rank_threshold *= self._rank_mat.max().max() / 100
-        # turn all values below threshold to nan, keep it df
-        if absolute_threshold:
-            self._threshold_mat = self._mat.where(self._mat >= absolute_threshold, np.nan)
-            if rank_threshold:
-                self._threshold_mat += self._rank_mat.where(self._rank_mat >= rank_threshold, np.nan)
-        elif rank_threshold:
-            self._threshold_mat = self._rank_mat.where(self._rank_mat >= rank_threshold, np.nan)
-
-        return {name: (seq, self.__identify(seq)) for name, seq in seqs.items()}
+        kmer_hits = self.kmer_hits(absolute_threshold, rank_threshold)
+        seqs_indices = {name: kmer_indices(seq, self._mer) for name, seq in seqs.items()}
+        # the k-mers shared by the sequences (like the variants of a reference) are named once
+        names = kmer_hits.names_of(set().union(*(indices[valid].tolist() for indices, valid in seqs_indices.values())))
+        return {name: (seq, self.__identify(*seqs_indices[name], names)) for name, seq in seqs.items()}
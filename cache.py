@@ -0,0 +1,186 @@
+import os
+import threading
+from collections import OrderedDict
+
+
+class BoundedCache:
+    # thread safe LRU cache bounded by the total size of its values, with hit/miss/eviction counters
+    def __init__(self, max_bytes, sizeof):
+        self._max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def get_many(self, keys):
+        # {key: value} of the keys which are cached, under a single lock
+        values = {}
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                self._entries.move_to_end(key)
+                values[key] = entry[0]
+        return values
+
+    def put(self, key, value):
+        size = self._sizeof(value)
+        with self._lock:
+            if key in self._entries:
+                self.bytes -= self._entries.pop(key)[1]
+            # values larger than the whole budget are not kept
+            if size > self._max_bytes:
+                return value
+            self._entries[key] = value, size
+            self.bytes += size
+            while self.bytes > self._max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+        return value
+
+    def get_or_create(self, key, create):
+        # the value is created outside the lock, concurrent misses of the same key may create it twice
+        value = self.get(key, self)
+        if value is self:
+            value = self.put(key, create())
+        return value
+
+    def discard(self, predicate):
+        # remove all the entries whose key matches the predicate
+        with self._lock:
+            for key in [key for key in self._entries if predicate(key)]:
+                self.bytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.bytes, 'max_bytes': self._max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class TieredCache:
+    # bytes values in a BoundedCache, in front of a directory shared by all the processes.
+    # the directory is bounded by the total size of its files, the least recently used are removed first
+    def __init__(self, directory, max_bytes, max_disk_bytes):
+        self.memory = BoundedCache(max_bytes, sizeof=len)
+        self._directory = directory
+        self._max_disk_bytes = max_disk_bytes
+        # counted on the first write, then kept up to date by this process
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self.disk_hits, self.disk_misses = 0, 0
+
+    def _path(self, key):
+        return os.path.join(self._directory, key[:2], key[2:])
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None:
+            path = self._path(key)
+            try:
+                with open(path, 'rb') as f:
+                    value = f.read()
+                # the mtime orders the files by their last use
+                os.utime(path)
+            except FileNotFoundError:
+                self.disk_misses += 1
+                return None
+            self.disk_hits += 1
+            self.memory.put(key, value)
+        return value
+
+    def put(self, key, value):
+        self.memory.put(key, value)
+        if len(value) <= self._max_disk_bytes:
+            self._write(key, [value])
+        return value
+
+    def put_chunks(self, key, chunks):
+        # a value written to the directory one chunk of bytes at a time, it is read into memory by its first get
+        self._write(key, chunks)
+
+    def _write(self, key, chunks):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # written aside and renamed, other processes never read a partial value
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        size = 0
+        try:
+            with open(tmp_path, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    size += len(chunk)
+            if size > self._max_disk_bytes:
+                os.remove(tmp_path)
+                return
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = sum(size for _, size, _ in self._disk_files())
+            else:
+                self._disk_bytes += size
+            if self._disk_bytes > self._max_disk_bytes:
+                self._trim()
+
+    def _disk_files(self):
+        # (mtime, size, path) of the cached files, other processes may remove them meanwhile
+        files = []
+        for root, _, names in os.walk(self._directory):
+            for name in names:
+                if name.endswith('.tmp'):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        return files
+
+    def _trim(self):
+        # remove the least recently used files down to 90% of the budget, so the directory is not scanned every write
+        files = sorted(self._disk_files())
+        total = sum(size for _, size, _ in files)
+        for _, size, path in files:
+            if total <= self._max_disk_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._disk_bytes = total
+
+    def disk_stats(self):
+        return {'hits': self.disk_hits, 'misses': self.disk_misses, 'bytes': self._disk_bytes}
+
+    def stats(self):
+        return {**self.memory.stats(), 'disk_bytes': self._disk_bytes, 'max_disk_bytes': self._max_disk_bytes,
+                'disk_hits': self.disk_hits, 'disk_misses': self.disk_misses}
@@ -0,0 +1,37 @@
+import os
+import shutil
+
+import numpy as np
+
+import consts
+import bindline
+
+# merge the segments appended by update_matrices.py into the base matrices
+matrix_paths = [consts.ESCORE_MATRIX_NPY, consts.ZSCORE_MATRIX_NPY, consts.ISCORE_MATRIX_NPY, consts.ESCORE_RANK_MATRIX_NPY]
+manifest = bindline.read_matrix_manifest(consts.MATRIX_DIR)
+if not manifest['segments']:
+    print('No segments to compact')
+    exit()
+
+print(f'Compacting segments {", ".join(manifest["segments"])}')
+for path in matrix_paths:
+    segmented = bindline.load_score_matrix(path)
+    if path == consts.ESCORE_RANK_MATRIX_NPY:
+        # the ranks are compacted to integers, NaN rows are not ranked
+        score_matrix = bindline.ScoreMatrix.allocate(path, segmented.index, segmented.mer, fill=0,
+                                                     dtype=bindline.RANK_DTYPE)
+    else:
+        score_matrix = bindline.ScoreMatrix.allocate(path, segmented.index, segmented.mer)
+    # copy segment by segment, the mapped segments are not loaded at once
+    for segment, start in zip(segmented.segments, segmented.offsets):
+        values = segment.values
+        if score_matrix.values.dtype == bindline.RANK_DTYPE:
+            values = np.nan_to_num(values, nan=0)
+        score_matrix.values[start:start + len(segment)] = values
+    score_matrix.commit(path)
+    bindline.KmerIndex.build(score_matrix).save(path)
+
+# the base matrices contain all the rows, the segments are no longer needed
+bindline.write_matrix_manifest(consts.MATRIX_DIR, {'segments': []})
+for segment in manifest['segments']:
+    shutil.rmtree(os.path.join(consts.MATRIX_DIR, bindline.MATRIX_SEGMENTS_DIR, segment), ignore_errors=True)
@@ -11,4 +11,56 @@ ZSCORE_MATRIX_PKL = os.path.join(UPLOAD_DIR, 'zscore_matrix.pkl')
 ISCORE_MATRIX_PKL = os.path.join(UPLOAD_DIR, 'iscore_matrix.pkl')
 ESCORE_RANK_MATRIX_PKL = os.path.join(UPLOAD_DIR, 'escore_rank_matrix.pkl')
 
+# memory mapped score matrices (rows are listed in a ".rows.txt" sidecar next to each matrix)
+MATRIX_DIR = os.path.join(UPLOAD_DIR, 'matrices')
+ESCORE_MATRIX_NPY = os.path.join(MATRIX_DIR, 'escore_matrix.npy')
+ZSCORE_MATRIX_NPY = os.path.join(MATRIX_DIR, 'zscore_matrix.npy')
+ISCORE_MATRIX_NPY = os.path.join(MATRIX_DIR, 'iscore_matrix.npy')
+ESCORE_RANK_MATRIX_NPY = os.path.join(MATRIX_DIR, 'escore_rank_matrix.npy')
+
+# memory budget of the parsed score tables kept by the server
+TABLE_CACHE_BYTES = 256 * 1024 ** 2
+# memory budget of the identified rows of the k-mers, for all the threshold presets
+KMER_HITS_CACHE_BYTES = 64 * 1024 ** 2
+
+# sequence alignments shared by all the server workers, keyed by a hash of the sequence pair
+ALIGNMENT_CACHE_DIR = os.path.join(UPLOAD_DIR, 'alignments')
+# memory budget of the alignments kept by each worker, in front of the disk cache
+ALIGNMENT_CACHE_BYTES = 32 * 1024 ** 2
+# disk budget of the alignments shared by all the workers, the least recently used are removed
+ALIGNMENT_CACHE_DISK_BYTES = 256 * 1024 ** 2
+# processes aligning batches of sequences, 1 aligns them in the server process.
+# every server worker starts its own, each importing Biopython: a server of k workers runs up to
+# k * ALIGNMENT_WORKERS of them, size it so they fit the CPUs and memory of the host
+ALIGNMENT_WORKERS = 2
+
+# score files scored together in a streamed /upload response, each chunk is sent once it is done
+STREAM_CHUNK_FILES = 4
+
+# serialized plot data of the analyses, keyed by a fingerprint of their inputs
+RESULT_CACHE_DIR = os.path.join(UPLOAD_DIR, 'results')
+# memory budget of the results kept by each worker, in front of the disk cache
+RESULT_CACHE_BYTES = 128 * 1024 ** 2
+# disk budget of the results shared by all the workers, the least recently used are removed
+RESULT_CACHE_DISK_BYTES = 2 * 1024 ** 3
+
+# long analyses (the significant mutations search) run as background jobs by a bounded pool of threads.
+# the jobs live in the server process which submitted them: the server must run a single process (with threads),
+# or route the requests of a job (/jobs/<id>...) to the process which submitted it
+JOB_WORKERS = 2
+# jobs waiting or running at once, more are rejected
+MAX_PENDING_JOBS = 16
+# finished jobs keep their results this long
+JOB_RETENTION_SECONDS = 15 * 60
+# the clients poll the status of a job. the status events hold a connection (and a sync worker) for the whole job,
+# enable them only for a threaded or async server
+JOB_EVENTS = False
+# the status events of a job are sent at least this often, keeping the connection open
+JOB_EVENTS_INTERVAL_SECONDS = 15
+
+# stage spans and request latencies, exposed at /metrics. spans cost a single check when disabled
+METRICS_ENABLED = True
+# add the durations of the stages of each request in a Server-Timing header
+SERVER_TIMING = False
+
 DNA_BASES = ['A', 'C', 'G', 'T']
\ No newline at end of file
@@ -0,0 +1,23 @@
+import os
+
+import numpy as np
+
+import consts
+import bindline
+
+# convert the pickled score matrices of older builds to the memory mapped store, with their k-mer indices
+for pkl_path, npy_path in [(consts.ESCORE_MATRIX_PKL, consts.ESCORE_MATRIX_NPY),
+                           (consts.ZSCORE_MATRIX_PKL, consts.ZSCORE_MATRIX_NPY),
+                           (consts.ISCORE_MATRIX_PKL, consts.ISCORE_MATRIX_NPY),
+                           (consts.ESCORE_RANK_MATRIX_PKL, consts.ESCORE_RANK_MATRIX_NPY)]:
+    if not os.path.exists(pkl_path):
+        print(f'{pkl_path} does not exist, skipping')
+        continue
+    print(f'Converting {pkl_path} to {npy_path}')
+    score_matrix = bindline.ScoreMatrix.load(pkl_path)
+    if npy_path == consts.ESCORE_RANK_MATRIX_NPY:
+        # the ranks are integers, NaN rows are not ranked
+        score_matrix = bindline.ScoreMatrix(np.nan_to_num(score_matrix.values, nan=0).astype(bindline.RANK_DTYPE),
+                                            score_matrix.index)
+    score_matrix.save(npy_path)
+    bindline.KmerIndex.build(score_matrix).save(npy_path)
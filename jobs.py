@@ -0,0 +1,134 @@
+import time
+import uuid
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = 'queued', 'running', 'done', 'failed', 'cancelled'
+FINISHED_STATES = {DONE, FAILED, CANCELLED}
+
+logger = logging.getLogger(__name__)
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class QueueFull(Exception):
+    pass
+
+
+class Job:
+    # an analysis run by the queue. the work reports its progress through the job, and stops once it is cancelled
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.state = QUEUED
+        self.done, self.total = 0, None
+        self.result, self.error = None, None
+        self.created, self.finished = time.time(), None
+        # incremented on every change, waiters are woken by the condition
+        self.version = 0
+        self._changed = threading.Condition()
+        self._cancelled = threading.Event()
+
+    @property
+    def is_finished(self):
+        return self.state in FINISHED_STATES
+
+    def _update(self, **fields):
+        with self._changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self._changed.notify_all()
+
+    def progress(self, done, total):
+        # called by the work between its steps, raises JobCancelled to stop it once the job is cancelled
+        if self._cancelled.is_set():
+            raise JobCancelled()
+        self._update(done=done, total=total)
+
+    def cancel(self):
+        # a queued job never starts, a running one stops at its next progress report
+        with self._changed:
+            self._cancelled.set()
+            if self.state == QUEUED:
+                self.finish(CANCELLED)
+
+    def start(self):
+        with self._changed:
+            if self._cancelled.is_set():
+                return False
+            self._update(state=RUNNING)
+            return True
+
+    def finish(self, state, result=None, error=None):
+        self._update(state=state, result=result, error=error, finished=time.time())
+
+    def wait(self, version, timeout):
+        # the version of the job once it changed after the given version, or the timeout passed
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != version, timeout)
+            return self.version
+
+    def status(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'state': self.state,
+            'done': self.done,
+            'total': self.total,
+            'error': self.error,
+        }
+
+
+class JobQueue:
+    # jobs run by a bounded pool of threads. finished jobs are kept until they expire
+    def __init__(self, workers, max_pending, retention_seconds):
+        self._workers = workers
+        self._max_pending = max_pending
+        self._retention_seconds = retention_seconds
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        # started with the first job
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self._workers, thread_name_prefix='job')
+        return self._executor
+
+    def submit(self, kind, work):
+        # run work(job) in the pool, its return value is the result of the job
+        with self._lock:
+            self._expire()
+            if sum(not job.is_finished for job in self._jobs.values()) >= self._max_pending:
+                raise QueueFull(f'Too many analyses are running, at most {self._max_pending}')
+            job = Job(kind)
+            self._jobs[job.id] = job
+            self._get_executor().submit(self._run, job, work)
+        return job
+
+    @staticmethod
+    def _run(job, work):
+        if not job.start():
+            return
+        try:
+            job.finish(DONE, result=work(job))
+        except JobCancelled:
+            job.finish(CANCELLED)
+        except Exception as e:
+            logger.exception('Job %s failed', job.id)
+            job.finish(FAILED, error=str(e))
+
+    def get(self, job_id):
+        with self._lock:
+            self._expire()
+            return self._jobs.get(job_id)
+
+    def _expire(self):
+        # the lock is held by the caller
+        expired = time.time() - self._retention_seconds
+        for job_id in [job.id for job in self._jobs.values() if job.is_finished and job.finished < expired]:
+            del self._jobs[job_id]
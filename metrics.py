@@ -0,0 +1,154 @@
+import time
+import bisect
+import functools
+import threading
+import contextlib
+import contextvars
+
+import consts
+
+# latency histogram buckets, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+STAGE_SECONDS = 'bindline_stage_seconds'
+REQUEST_SECONDS = 'bindline_request_seconds'
+HELP = {
+    STAGE_SECONDS: 'Duration of the instrumented stages',
+    REQUEST_SECONDS: 'Duration of the requests until their response is returned (streamed bodies are not included)',
+}
+
+# spans are not timed when disabled, they cost a single check
+enabled = consts.METRICS_ENABLED
+
+_histograms = {}
+_caches = {}
+_lock = threading.Lock()
+# {stage: seconds} of the current request, for its Server-Timing header. None outside of requests
+_request_timings = contextvars.ContextVar('request_timings', default=None)
+NULL_SPAN = contextlib.nullcontext()
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sum, self.count = 0.0, 0
+
+    def observe(self, value):
+        # the bucket of the value is the first whose bound is not below it, the last is +Inf
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def observe(name, labels, value):
+    # labels is a tuple of (label, value) pairs
+    with _lock:
+        histogram = _histograms.get((name, labels))
+        if histogram is None:
+            histogram = _histograms[name, labels] = Histogram()
+        histogram.observe(value)
+
+
+def observe_stage(stage, seconds):
+    observe(STAGE_SECONDS, (('stage', stage),), seconds)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0) + seconds
+
+
+@contextlib.contextmanager
+def _span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - start)
+
+
+def span(stage):
+    return _span(stage) if enabled else NULL_SPAN
+
+
+def timed(stage):
+    # decorator, a span around every call of the function
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return fn(*args, **kwargs)
+            with _span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def start_request():
+    # the stages of the request are collected from here, returns the token to end it
+    return _request_timings.set({})
+
+
+def end_request(token):
+    # {stage: seconds} of the request
+    timings = _request_timings.get()
+    _request_timings.reset(token)
+    return timings or {}
+
+
+def register_cache(name, stats):
+    # stats() returns the counters of the cache, at least 'hits' and 'misses' (see BoundedCache.stats)
+    _caches[name] = stats
+
+
+def lru_cache_stats(fn):
+    # the stats of a functools.lru_cache function
+    def stats():
+        info = fn.cache_info()
+        return {'hits': info.hits, 'misses': info.misses, 'entries': info.currsize}
+    return stats
+
+
+def format_labels(labels):
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}' if labels else ''
+
+
+def render():
+    # all the metrics in the Prometheus text format
+    lines = []
+    with _lock:
+        histograms = {key: (list(h.counts), h.sum, h.count) for key, h in _histograms.items()}
+    for name in sorted({name for name, _ in histograms}):
+        lines += [f'# HELP {name} {HELP.get(name, name)}', f'# TYPE {name} histogram']
+        for (histogram_name, labels), (counts, total, count) in sorted(histograms.items()):
+            if histogram_name != name:
+                continue
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(f'{name}_bucket{format_labels(labels + (("le", bound),))} {cumulative}')
+            lines.append(f'{name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{name}_count{format_labels(labels)} {count}')
+
+    caches = {name: stats() for name, stats in sorted(_caches.items())}
+    cache_metrics = [
+        ('bindline_cache_hits_total', 'counter', 'Lookups of the cache which found the value', 'hits'),
+        ('bindline_cache_misses_total', 'counter', 'Lookups of the cache which did not find the value', 'misses'),
+        ('bindline_cache_evictions_total', 'counter', 'Values removed from the cache to keep its budget', 'evictions'),
+        ('bindline_cache_entries', 'gauge', 'Values in the cache', 'entries'),
+        ('bindline_cache_bytes', 'gauge', 'Size of the values in the cache', 'bytes'),
+    ]
+    for name, metric_type, help_text, field in cache_metrics:
+        lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}']
+        lines += [f'{name}{format_labels((("cache", cache),))} {stats[field]}'
+                  for cache, stats in caches.items() if stats.get(field) is not None]
+    lines += ['# HELP bindline_cache_hit_ratio Hits out of all the lookups of the cache',
+              '# TYPE bindline_cache_hit_ratio gauge']
+    for cache, stats in caches.items():
+        lookups = stats['hits'] + stats['misses']
+        lines.append(f'bindline_cache_hit_ratio{format_labels((("cache", cache),))} '
+                     f'{stats["hits"] / lookups if lookups else 0}')
+    return '\n'.join(lines) + '\n'
+
+
+def server_timing(timings):
+    # the Server-Timing header of the stages, in milliseconds
+    return ', '.join(f'{"".join(c if c.isalnum() or c in "-_." else "_" for c in stage)};dur={seconds * 1000:.1f}'
+                     for stage, seconds in timings.items())
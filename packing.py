@@ -0,0 +1,98 @@
+import gzip
+import json
+import struct
+
+import numpy as np
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# the packed plot data, asked for by the client in the Accept header:
+# MAGIC, the length of the header, the JSON header (padded to 4 bytes), the float32 (little endian) arrays.
+# in the header "data" is the plot data, where each list of numbers is replaced by {"$a": index} of its array
+# and each long string by {"$s": index} of its string, both deduplicated. None values are NaN in the arrays
+PACKED_MIMETYPE = 'application/x-bindline-packed'
+MAGIC = b'BLP1'
+ARRAY_REF, STRING_REF = '$a', '$s'
+# shorter lists and strings are left in the JSON header
+MIN_ARRAY_LENGTH = 8
+MIN_STRING_LENGTH = 32
+# smaller bodies are not compressed
+MIN_COMPRESSED_BYTES = 1024
+
+
+def is_number_list(value):
+    return all(item is None or isinstance(item, (int, float)) and not isinstance(item, bool) for item in value)
+
+
+class Packer:
+    def __init__(self):
+        self.arrays, self._array_indices = [], {}
+        self.strings, self._string_indices = [], {}
+
+    def pack(self, value):
+        if isinstance(value, dict):
+            return {key: self.pack(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            if len(value) >= MIN_ARRAY_LENGTH and is_number_list(value):
+                array = np.array(value, dtype='<f4')
+                return {ARRAY_REF: self._index(self._array_indices, self.arrays, array.tobytes(), array)}
+            return [self.pack(item) for item in value]
+        if isinstance(value, str) and len(value) >= MIN_STRING_LENGTH:
+            return {STRING_REF: self._index(self._string_indices, self.strings, value, value)}
+        return value
+
+    @staticmethod
+    def _index(indices, values, key, value):
+        if key not in indices:
+            indices[key] = len(values)
+            values.append(value)
+        return indices[key]
+
+
+def dumps(plot_data):
+    packer = Packer()
+    data = packer.pack(plot_data)
+    offsets = np.cumsum([0] + [len(array) for array in packer.arrays])
+    header = json.dumps({
+        'data': data,
+        'strings': packer.strings,
+        'arrays': [[int(offset), len(array)] for offset, array in zip(offsets, packer.arrays)],
+    }).encode()
+    header += b' ' * (-len(header) % 4)
+    return b''.join([MAGIC, struct.pack('<I', len(header)), header] + [array.tobytes() for array in packer.arrays])
+
+
+def loads(body):
+    if body[:4] != MAGIC:
+        raise ValueError('Not a packed plot data')
+    header_length, = struct.unpack('<I', body[4:8])
+    header = json.loads(body[8:8 + header_length])
+    floats = np.frombuffer(body, dtype='<f4', offset=8 + header_length)
+    arrays = [[None if np.isnan(value) else value for value in floats[offset:offset + length].tolist()]
+              for offset, length in header['arrays']]
+
+    def unpack(value):
+        if isinstance(value, dict):
+            if ARRAY_REF in value:
+                return arrays[value[ARRAY_REF]]
+            if STRING_REF in value:
+                return header['strings'][value[STRING_REF]]
+            return {key: unpack(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [unpack(item) for item in value]
+        return value
+    return unpack(header['data'])
+
+
+def compress(body, accept_encodings):
+    # (body, content encoding) by the best encoding the client accepts, the encoding is None if not compressed
+    if len(body) < MIN_COMPRESSED_BYTES:
+        return body, None
+    if brotli is not None and 'br' in accept_encodings:
+        return brotli.compress(body, quality=5), 'br'
+    if 'gzip' in accept_encodings:
+        return gzip.compress(body, compresslevel=6), 'gzip'
+    return body, None
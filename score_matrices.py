@@ -1,65 +1,100 @@
 import os
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
 import tqdm
-import itertools
 import numpy as np
-import pandas as pd
 
 import consts
 import bindline
 
-# write all escore file paths to a list
-escore_files = []
-for root, dirs, files in os.walk(consts.ESCORE_DIR):
-    for file in files:
-        if file.endswith(".txt"):
-            escore_files.append(os.path.join(root.replace(consts.ESCORE_DIR, '').strip('/\\'), file))
-# write to a file
-with open(consts.ESCORE_FILE_LIST, 'w') as f:
-    for file in escore_files:
-        f.write(file + '\n')
-
-# for each file, read the escore matrix and make a matrix of the scores
-cols_order = [''.join(i) for i in itertools.product('ACGT', repeat=8)]
-mat = np.full((len(escore_files), len(cols_order)), np.nan)
-zscore_mat = np.full((len(escore_files), len(cols_order)), np.nan)
-iscore_mat = np.full((len(escore_files), len(cols_order)), np.nan)
-ranks_mat = np.full((len(escore_files), len(cols_order)), np.nan)
-
-# for each file
-for file in tqdm.tqdm(open(consts.ESCORE_FILE_LIST, 'r').readlines()):
-    file = file.strip()
-    escore_file = bindline.UniProbeEScoreFile(open(os.path.join(consts.ESCORE_DIR, file.strip())).read())
-    zscore_file = bindline.UniProbeZScoreFile(open(os.path.join(consts.ESCORE_DIR, file.strip())).read())
-    iscore_file = bindline.UniProbeIScoreFile(open(os.path.join(consts.ESCORE_DIR, file.strip())).read())
-    _, _, escore_table = next(escore_file.parse_tables())
-    try: _, _, zscore_table = next(zscore_file.parse_tables())
-    except: zscore_table = None
-    try: _, _, iscore_table = next(iscore_file.parse_tables())
-    except: iscore_table = None
-    if len(escore_table._dict) != len(cols_order):
-        print(file, len(escore_table._dict))
-    else:
-        # order the scores according to the cols_order
-        mat[escore_files.index(file)] = np.array([escore_table._dict[mer] for mer in cols_order])
-        if zscore_table is not None:
-            zscore_mat[escore_files.index(file)] = np.array([zscore_table._dict[mer] for mer in cols_order])
-        if iscore_table is not None:
-            iscore_mat[escore_files.index(file)] = np.array([iscore_table._dict[mer] for mer in cols_order])
-        ranks_mat[escore_files.index(file)] = np.argsort(np.argsort(mat[escore_files.index(file)]))
-
-# save the matrix
-df = pd.DataFrame(mat, index=escore_files)
-zscore_df = pd.DataFrame(zscore_mat, index=escore_files)
-iscore_df = pd.DataFrame(iscore_mat, index=escore_files)
-ranks_df = pd.DataFrame(ranks_mat, index=escore_files)
-
-# set column names
-df.columns = cols_order
-zscore_df.columns = cols_order
-iscore_df.columns = cols_order
-ranks_df.columns = cols_order
-
-df.to_pickle(consts.ESCORE_MATRIX_PKL)
-zscore_df.to_pickle(consts.ZSCORE_MATRIX_PKL)
-iscore_df.to_pickle(consts.ISCORE_MATRIX_PKL)
-ranks_df.to_pickle(consts.ESCORE_RANK_MATRIX_PKL)
+MER = 8
+# the matrix of each score type, filled by the workers
+SCORE_MATRIX_PATHS = {'E': consts.ESCORE_MATRIX_NPY, 'Z': consts.ZSCORE_MATRIX_NPY, 'I': consts.ISCORE_MATRIX_NPY}
+MATRIX_PATHS = {**SCORE_MATRIX_PATHS, 'rank': consts.ESCORE_RANK_MATRIX_NPY}
+# rows ranked together, bounds the memory of the ranking
+RANK_CHUNK_ROWS = 64
+
+
+def list_escore_files():
+    # all escore file paths, relative to the escore directory
+    escore_files = []
+    for root, dirs, files in os.walk(consts.ESCORE_DIR):
+        for file in files:
+            if file.endswith(".txt"):
+                escore_files.append(os.path.join(root.replace(consts.ESCORE_DIR, '').strip('/\\'), file))
+    return escore_files
+
+
+def build_row(row, file):
+    # parse all the score types of the file once, and write them to its row of the allocated matrices.
+    # returns the error of the file, None if it succeeded
+    try:
+        arrays = bindline.load_mer8_arrays(os.path.join(consts.ESCORE_DIR, file))
+        if 'E' not in arrays:
+            return 'no E-score column'
+        missing_mers = np.isnan(arrays['E']).sum()
+        if missing_mers:
+            return f'{len(arrays["E"]) - missing_mers} 8-mers out of {len(arrays["E"])}'
+        for score_type, path in SCORE_MATRIX_PATHS.items():
+            if score_type in arrays:
+                values = bindline.ScoreMatrix.open_allocated(path)
+                values[row] = arrays[score_type]
+                values.flush()
+    except Exception as e:
+        return f'{type(e).__name__}: {e}'
+
+
+def build_matrices(escore_files, workers=None):
+    # fill the matrices in parallel, each worker writes directly to the mapped rows of its files
+    matrices = {score_type: bindline.ScoreMatrix.allocate(path, escore_files, MER)
+                for score_type, path in SCORE_MATRIX_PATHS.items()}
+    matrices['rank'] = bindline.ScoreMatrix.allocate(MATRIX_PATHS['rank'], escore_files, MER, fill=0,
+                                                     dtype=bindline.RANK_DTYPE)
+    for score_matrix in matrices.values():
+        score_matrix.values.flush()
+
+    failures = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(build_row, row, file): file for row, file in enumerate(escore_files)}
+        for future in tqdm.tqdm(as_completed(futures), total=len(futures)):
+            error = future.result()
+            if error:
+                failures[futures[future]] = error
+
+    # rank the E-scores of all the rows, in batches of rows
+    escores = bindline.ScoreMatrix.open_allocated(MATRIX_PATHS['E'])
+    ranks = bindline.ScoreMatrix.open_allocated(MATRIX_PATHS['rank'])
+    for start in range(0, len(escore_files), RANK_CHUNK_ROWS):
+        ranks[start:start + RANK_CHUNK_ROWS] = bindline.rank_matrix(escores[start:start + RANK_CHUNK_ROWS])
+    ranks.flush()
+
+    # save the matrices and their k-mer indices
+    for score_type, path in MATRIX_PATHS.items():
+        score_matrix = bindline.ScoreMatrix(np.load(path + '.tmp', mmap_mode='r'), escore_files)
+        score_matrix.commit(path)
+        bindline.KmerIndex.build(score_matrix).save(path)
+    return failures
+
+
+def report_failures(failures, total):
+    # the rows of the failed files are left empty (NaN)
+    print(f'{total - len(failures)} out of {total} files were added to the matrices')
+    if failures:
+        print(f'{len(failures)} files failed:')
+        for file, error in sorted(failures.items()):
+            print(f'  {file}\t{error}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=None, help="Number of worker processes (default: CPU count)")
+    args = parser.parse_args()
+
+    escore_files = list_escore_files()
+    # write to a file
+    with open(consts.ESCORE_FILE_LIST, 'w') as f:
+        for file in escore_files:
+            f.write(file + '\n')
+
+    report_failures(build_matrices(escore_files, args.workers), len(escore_files))
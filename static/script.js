@@ -212,12 +212,19 @@ async function uploadAndPlot() {
         hideGlobalLoading();
         return;
     }
+    // the significant mutations search runs in the background, followed by its progress
+    if (formData.get('search_significant_mutations') === 'true') {
+        await runAnalysisJob(formData).catch(handleError);
+        return;
+    }
+    // the plots are drawn while the score files are computed (only when no search is selected)
+    formData.append('stream', 'true');
     formData.forEach((value, key) => console.log(key, value));
 
 
-    await fetch('/upload', { method: 'POST', body: formData })
-        .then(response => response.json())
-        .then(plotData => handlePlotData(plotData))
+    // searches are answered at once, in the packed encoding
+    await fetch('/upload', { method: 'POST', body: formData, headers: { 'Accept': `${PACKED_MIMETYPE}, application/json` } })
+        .then(response => isStreamed(response) ? handlePlotDataStream(response) : readPlotData(response).then(handlePlotData))
         .catch(handleError);
 }
 
@@ -313,9 +320,11 @@ function validateConditions(selectedSequences) {
 }
 
 
-/** Handle plot data and render plots */
-async function handlePlotData(plotData) {
-    hideGlobalLoading();
+/** Handle plot data and render plots, the loading stays shown while the plot data is partial */
+async function handlePlotData(plotData, partial = false) {
+    if (!partial) {
+        hideGlobalLoading();
+    }
 
     if (plotData.error) {
         alert(plotData.error);
@@ -384,6 +393,152 @@ async function handlePlotData(plotData) {
 }
 
 
+const STREAM_RENDER_INTERVAL_MS = 1000; // Minimal time between redraws while the files are streamed
+
+/** Whether the response is a stream of JSON lines */
+function isStreamed(response) {
+    return (response.headers.get('Content-Type') || '').startsWith('application/x-ndjson');
+}
+
+/** Read a stream of JSON lines, calling onLine with each parsed line */
+async function readJsonLines(response, onLine) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { done, value } = await reader.read();
+        buffer += decoder.decode(value, { stream: !done });
+        const lines = buffer.split('\n');
+        buffer = done ? '' : lines.pop(); // Keep the incomplete last line for the next chunk
+        lines.filter(line => line.trim()).forEach(line => onLine(JSON.parse(line)));
+        if (done) break;
+    }
+}
+
+/** Build the plot data from the streamed lines, and redraw the plots as the score files arrive */
+async function handlePlotDataStream(response) {
+    const plotData = {};
+    let lastRender = 0;
+    let failed = false;
+    await readJsonLines(response, line => {
+        if (failed) return;
+        if (line.error) {
+            failed = true;
+            handlePlotData(line);
+        } else if (line.file !== undefined) {
+            // the entries of one score file in each of its fields
+            Object.entries(line.data).forEach(([field, entry]) => plotData[field][line.file] = entry);
+            if (Date.now() - lastRender >= STREAM_RENDER_INTERVAL_MS) {
+                lastRender = Date.now();
+                handlePlotData(plotData, true);
+            }
+        } else if (line.fields) {
+            // the fields shared by all the files come first
+            Object.assign(plotData, line);
+            line.fields.forEach(field => plotData[field] = {});
+        }
+    });
+    if (!failed) {
+        handlePlotData(plotData);
+    }
+}
+
+
+const PACKED_MIMETYPE = 'application/x-bindline-packed'; // see packing.py
+const PACKED_ARRAY_REF = '$a';
+const PACKED_STRING_REF = '$s';
+
+/** Read the plot data of a response, JSON or packed */
+async function readPlotData(response) {
+    if ((response.headers.get('Content-Type') || '').startsWith(PACKED_MIMETYPE)) {
+        return decodePackedPlotData(await response.arrayBuffer());
+    }
+    return response.json();
+}
+
+/** Decode the packed plot data into the structures of the JSON plot data, NaN values become null */
+function decodePackedPlotData(buffer) {
+    const headerLength = new DataView(buffer).getUint32(4, true);
+    const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength)));
+    const floats = new Float32Array(buffer, 8 + headerLength);
+    // deduplicated arrays are shared by all their references
+    const arrays = header.arrays.map(([offset, length]) =>
+        Array.from(floats.subarray(offset, offset + length), value => Number.isNaN(value) ? null : value));
+
+    const unpack = value => {
+        if (Array.isArray(value)) return value.map(unpack);
+        if (value === null || typeof value !== 'object') return value;
+        if (PACKED_ARRAY_REF in value) return arrays[value[PACKED_ARRAY_REF]];
+        if (PACKED_STRING_REF in value) return header.strings[value[PACKED_STRING_REF]];
+        return Object.fromEntries(Object.entries(value).map(([key, item]) => [key, unpack(item)]));
+    };
+    return unpack(header.data);
+}
+
+
+const JOB_FINISHED_STATES = ['done', 'failed', 'cancelled'];
+const JOB_POLL_INTERVAL_MS = 1000; // Polling interval of the job status
+let currentJobId = null; // The running analysis job, cancelled when another analysis starts
+
+/** Run the analysis as a background job: submit it, follow its progress, and plot its result */
+async function runAnalysisJob(formData) {
+    if (currentJobId) {
+        fetch(`/jobs/${currentJobId}`, { method: 'DELETE' });
+    }
+    const submitted = await fetch('/jobs', { method: 'POST', body: formData }).then(response => response.json());
+    if (!submitted.id) {
+        handlePlotData(submitted); // Shows the error
+        return;
+    }
+    currentJobId = submitted.id;
+    const status = await (submitted.events ? followJob(submitted.id) : pollJob(submitted.id));
+    if (currentJobId !== submitted.id) return; // Replaced by a newer analysis
+    currentJobId = null;
+    if (status.state !== 'done') {
+        handlePlotData({ error: status.error || `The analysis was ${status.state}.` });
+        return;
+    }
+    const response = await fetch(`/jobs/${submitted.id}/result`, { headers: { 'Accept': `${PACKED_MIMETYPE}, application/json` } });
+    handlePlotData(await readPlotData(response));
+}
+
+/** Resolve with the final status of the job, from its progress events (when the server enables them), or by polling it if they fail */
+function followJob(jobId) {
+    return new Promise(resolve => {
+        const events = new EventSource(`/jobs/${jobId}/events`);
+        events.onmessage = event => {
+            const status = JSON.parse(event.data);
+            showJobProgress(status);
+            if (JOB_FINISHED_STATES.includes(status.state)) {
+                events.close();
+                resolve(status);
+            }
+        };
+        events.onerror = () => {
+            events.close();
+            resolve(pollJob(jobId));
+        };
+    });
+}
+
+/** Poll the status of the job until it is finished (or unknown) */
+async function pollJob(jobId) {
+    while (true) {
+        const status = await fetch(`/jobs/${jobId}`).then(response => response.json());
+        showJobProgress(status);
+        if (!status.id || JOB_FINISHED_STATES.includes(status.state)) return status;
+        await new Promise(resolve => setTimeout(resolve, JOB_POLL_INTERVAL_MS));
+    }
+}
+
+/** Show the number of score files the job has done next to the loading message */
+function showJobProgress(status) {
+    const progress = document.getElementById('loading-progress');
+    if (progress && status.total) {
+        progress.textContent = ` (${status.done}/${status.total} score files)`;
+    }
+}
+
 /** Handle and log errors */
 function handleError(error) {
     hideGlobalLoading();
@@ -450,6 +605,10 @@ function createBindingSiteTraces(plotData) {
     const yLabels = []; // Store unique y-axis labels
 
     Object.entries(plotData.binding_sites).forEach(([fileName, fileBindingSites], fileIndex) => {
+        // files without added or removed binding sites have nothing to draw
+        if (plotData.binding_site_counts && !plotData.binding_site_counts[fileName]) {
+            return;
+        }
         const colorPalette = colorPalettes[fileIndex % colorPalettes.length];
 
         Object.entries(fileBindingSites).forEach(([seqName, bindingSites], seqIndex) => {
@@ -840,6 +999,8 @@ function hideGlobalLoading() {
     clearInterval(loadingInterval); // Stop animation
     const loadingDiv = document.getElementById("global-loading");
     if (loadingDiv) loadingDiv.style.display = "none"; // Hide message
+    const loadingProgress = document.getElementById("loading-progress");
+    if (loadingProgress) loadingProgress.textContent = ""; // Clear the job progress
 }
 
 
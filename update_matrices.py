@@ -1,4 +1,3 @@
-import pickle 
 import tqdm
 import numpy as np
 import consts
@@ -14,13 +13,9 @@ VERSION = args['VERSION']
 
 print(f'Upading data matrices by version {VERSION}')
 
-# Load the four saved matrices
-df_ls = []
-for path in [consts.ESCORE_MATRIX_PKL, consts.ZSCORE_MATRIX_PKL, consts.ISCORE_MATRIX_PKL, consts.ESCORE_RANK_MATRIX_PKL]:
-    with open(path, 'rb') as file:
-        df_ls.append(pickle.load(file))
-escore_df, zscore_df, iscore_df, ranks_df = df_ls
-cols_order = escore_df.columns
+# The version is appended as a new segment of the four matrices, the existing matrices are not read
+matrix_paths = [consts.ESCORE_MATRIX_NPY, consts.ZSCORE_MATRIX_NPY, consts.ISCORE_MATRIX_NPY, consts.ESCORE_RANK_MATRIX_NPY]
+MER = 8
 
 # Read the list file of all files included in the data
 with open(consts.ESCORE_FILE_LIST, 'r') as file:
@@ -30,40 +25,50 @@ with open(consts.ESCORE_FILE_LIST, 'r') as file:
 file_ls = list(file_ls[np.char.str_len(file_ls) > 0])
 
 
+new_rows, new_index = [[], [], [], []], []
+
 # For each file in the updates of the specific version
-for file in tqdm.tqdm(listdir(join(consts.UPDATES_DIR, VERSION))):
+for file in tqdm.tqdm([f for f in listdir(join(consts.UPDATES_DIR, VERSION)) if not bindline.is_mer8_sidecar(f)]):
 
     file_path = join(consts.UPDATES_DIR, VERSION, file)
 
-    # Get all of the tables
-    escore_file = bindline.UniProbeEScoreFile(open(file_path).read())
-    zscore_file = bindline.UniProbeZScoreFile(open(file_path).read())
-    iscore_file = bindline.UniProbeIScoreFile(open(file_path).read())
-    _, _, escore_table = next(escore_file.parse_tables())
-    try: _, _, zscore_table = next(zscore_file.parse_tables())
-    except: zscore_table = None
-    try: _, _, iscore_table = next(iscore_file.parse_tables())
-    except: iscore_table = None
-    if len(escore_table._dict) != len(cols_order):
-        print(file, len(escore_table._dict))
+    # Get all of the score types at once
+    arrays = bindline.load_mer8_arrays(file_path)
+    missing_mers = np.isnan(arrays['E']).sum()
+    if missing_mers:
+        print(file, 4 ** MER - missing_mers)
     else:
 
-        # For each score df append the values to the previous data frames
-        for df, table in zip([escore_df, zscore_df, iscore_df], [escore_table, zscore_table, iscore_table]):
-            if table is not None:
-                df.loc[file_path] = np.array([table._dict[mer] for mer in cols_order])
-
-        # Add the ranks values
-        ranks_df.loc[file_path] = np.argsort(np.argsort(escore_df.loc[file_path]))
+        # Collect the new rows of each score matrix, NaN where the score type is missing
+        for rows, score_type in zip(new_rows, ['E', 'Z', 'I']):
+            rows.append(np.array(arrays[score_type]) if score_type in arrays else np.full(4 ** MER, np.nan))
 
         # Add to the file list the current file
-        file_ls.append(file_path)
+        if file_path not in file_ls:
+            file_ls.append(file_path)
+        new_index.append(file_path)
+
+# Rank all the new rows at once
+new_rows[3] = [bindline.rank_matrix(np.vstack(new_rows[0]))] if new_rows[0] else []
+
+manifest = bindline.read_matrix_manifest(consts.MATRIX_DIR)
 
-escore_df.to_pickle(consts.ESCORE_MATRIX_PKL)
-zscore_df.to_pickle(consts.ZSCORE_MATRIX_PKL)
-iscore_df.to_pickle(consts.ISCORE_MATRIX_PKL)
-ranks_df.to_pickle(consts.ESCORE_RANK_MATRIX_PKL)
+# Write the new rows as the segment of the version, with its k-mer indices.
+# a version which was already added is replaced, a version without valid files has no segment
+if new_index:
+    for rows, path in zip(new_rows, matrix_paths):
+        segment_path = bindline.matrix_segment_path(path, VERSION)
+        score_matrix = bindline.ScoreMatrix(np.vstack(rows), new_index)
+        score_matrix.save(segment_path)
+        bindline.KmerIndex.build(score_matrix).save(segment_path)
+    if VERSION not in manifest['segments']:
+        manifest['segments'].append(VERSION)
+else:
+    print(f'No valid files in version {VERSION}, no segment is added')
+    if VERSION in manifest['segments']:
+        manifest['segments'].remove(VERSION)
+bindline.write_matrix_manifest(consts.MATRIX_DIR, manifest)
 
 with open(consts.ESCORE_FILE_LIST, 'w') as file:
     for file_path in file_ls:
-        file.write(f'{file_path}\n')
\ No newline at end of file
+        file.write(f'{file_path}\n')